@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+from openy import models
+
+
+class Command(BaseCommand):
+
+    help = "Compute the training statistics counters again from the position trainings"
+
+    def handle(self, *args, **options):
+        statistics = models.TrainingStatistics.rebuild()
+        self.stdout.write(
+            "%d trainings, %d covered, %d successes, %d failures" % (
+                statistics.trainings,
+                statistics.covered,
+                statistics.successes,
+                statistics.failures,
+            )
+        )
@@ -0,0 +1,47 @@
+# Generated by Django 3.2.25 on 2026-10-18 08:39
+
+from django.db import migrations, models
+
+
+def number_nodes(apps, schema_editor):
+    Node = apps.get_model("openy", "Node")
+    children = dict()
+    for uid, parent in Node.objects.values_list("uid", "parent_id").order_by("-uid"):
+        children.setdefault(parent, list()).append(uid)
+    counter = 0
+    stack = [(uid, 0, None) for uid in children.get(None, list())]
+    while len(stack) > 0:
+        uid, level, lft = stack.pop()
+        counter += 1
+        if lft is not None:
+            Node.objects.filter(uid=uid).update(lft=lft, rgt=counter, level=level)
+            continue
+        stack.append((uid, level, counter))
+        for child in children.get(uid, list()):
+            stack.append((child, level + 1, None))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('openy', '0006_auto_20200328_2113'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='node',
+            name='level',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='node',
+            name='lft',
+            field=models.PositiveIntegerField(db_index=True, default=0),
+        ),
+        migrations.AddField(
+            model_name='node',
+            name='rgt',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(number_nodes, migrations.RunPython.noop),
+    ]
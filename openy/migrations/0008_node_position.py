@@ -0,0 +1,28 @@
+# Generated by Django 3.2.25 on 2026-10-18 08:42
+
+from django.db import migrations, models
+import chess.polyglot
+import chess
+
+
+def fill_positions(apps, schema_editor):
+    Node = apps.get_model("openy", "Node")
+    for node in Node.objects.all():
+        node.position = "%016x" % chess.polyglot.zobrist_hash(chess.Board(node.fen))
+        node.save(update_fields=["position"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('openy', '0007_node_nested_set'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='node',
+            name='position',
+            field=models.CharField(db_index=True, default='', max_length=16),
+        ),
+        migrations.RunPython(fill_positions, migrations.RunPython.noop),
+    ]
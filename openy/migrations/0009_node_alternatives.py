@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-18 08:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('openy', '0008_node_position'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='node',
+            name='alternatives',
+            field=models.TextField(default=''),
+        ),
+    ]
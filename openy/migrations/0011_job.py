@@ -0,0 +1,27 @@
+# Generated by Django 3.2.25 on 2026-10-18 09:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('openy', '0010_repertoirestate'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Job',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(default='running', max_length=10)),
+                ('phase', models.CharField(default='', max_length=20)),
+                ('processed', models.PositiveIntegerField(default=0)),
+                ('total', models.PositiveIntegerField(blank=True, null=True)),
+                ('error', models.TextField(default='')),
+                ('date_creation', models.DateTimeField(auto_now_add=True)),
+                ('date_phase', models.DateTimeField(auto_now_add=True)),
+                ('date_update', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
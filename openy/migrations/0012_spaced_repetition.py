@@ -0,0 +1,45 @@
+# Generated by Django 3.2.25 on 2026-10-18 09:15
+
+from django.db import migrations, models
+from django.db.models import F
+
+
+def schedule_tried(apps, schema_editor):
+    PositionTraining = apps.get_model("openy", "PositionTraining")
+    PositionTraining.objects.exclude(last_try=None).update(due=F("last_try"))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('openy', '0011_job'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='positiontraining',
+            name='due',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='positiontraining',
+            name='easiness',
+            field=models.FloatField(default=2.5),
+        ),
+        migrations.AddField(
+            model_name='positiontraining',
+            name='interval',
+            field=models.FloatField(default=0.0),
+        ),
+        migrations.AddField(
+            model_name='positiontraining',
+            name='repetitions',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='trainingprofile',
+            name='scheduler',
+            field=models.CharField(choices=[('random', 'Weighted random'), ('sm2', 'Spaced repetition (SM-2)')], default='random', max_length=10),
+        ),
+        migrations.RunPython(schedule_tried, migrations.RunPython.noop),
+    ]
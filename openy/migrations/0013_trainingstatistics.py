@@ -0,0 +1,26 @@
+# Generated by Django 3.2.25 on 2026-10-18 09:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('openy', '0012_spaced_repetition'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TrainingStatistics',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('trainings', models.PositiveIntegerField(default=0)),
+                ('covered', models.PositiveIntegerField(default=0)),
+                ('successes', models.PositiveIntegerField(default=0)),
+                ('failures', models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-18 09:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('openy', '0013_trainingstatistics'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='trainingstatistics',
+            name='date_update',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-18 10:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('openy', '0014_trainingstatistics_date_update'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='repertoirestate',
+            name='exercise_generation',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
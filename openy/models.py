@@ -1,6 +1,10 @@
+import json
+import datetime
 from django.utils import timezone
 from django.db import models
+from django.db.models import F, Q, Count, Sum
 from django.urls import reverse
+import chess.polyglot
 import chess.svg
 import chess
 
@@ -17,6 +21,25 @@ def evaluation_to_float(evaluation):
     return float(evaluation)
 
 
+def position_key(board):
+    """Canonical key of a position, regardless of how it was reached: its
+       Polyglot Zobrist hash, in hexadecimal.
+    """
+    return "%016x" % chess.polyglot.zobrist_hash(board)
+
+
+def fen_to_position_key(fen):
+    """Return the position key of a FEN string, or None if the string is
+       invalid or only holds the piece placement.
+    """
+    if len(fen.split()) < 4:
+        return None
+    try:
+        return position_key(chess.Board(fen))
+    except ValueError:
+        return None
+
+
 class Node(models.Model):
 
     uid = models.IntegerField(unique=True, primary_key=True)
@@ -27,6 +50,11 @@ class Node(models.Model):
     parent = models.ForeignKey("self", on_delete=models.CASCADE, null=True, blank=True)
     line = models.TextField(default="", max_length=500)
     slug = models.SlugField(max_length=500, unique=True)
+    lft = models.PositiveIntegerField(default=0, db_index=True)
+    rgt = models.PositiveIntegerField(default=0)
+    level = models.PositiveIntegerField(default=0)
+    position = models.CharField(max_length=16, default="", db_index=True)
+    alternatives = models.TextField(default="")
 
     def __str__(self):
         return "%s (%s)" % (self.uid, self.short_label())
@@ -50,9 +78,11 @@ class Node(models.Model):
         return 2 * fullmove + 1
 
     def breadth(self):
-        if self.is_leaf():
-            return 1.
-        return sum(child.breadth() for child in self.children())
+        return float(Node.objects.filter(
+            lft__gte=self.lft,
+            rgt__lte=self.rgt,
+            rgt=F("lft") + 1
+        ).count())
 
     def short_label(self):
         return self.label.replace(". ...", "...")
@@ -63,15 +93,35 @@ class Node(models.Model):
     def children(self):
         return Node.objects.filter(parent__uid=self.uid)
 
+    def transpositions(self):
+        return Node.objects.filter(position=self.position).exclude(uid=self.uid)
+
     def siblings(self):
         return Node.objects.filter(parent=self.parent).exclude(uid=self.uid)
 
+    def descendants(self):
+        return Node.objects.filter(lft__gt=self.lft, rgt__lt=self.rgt)
+
     def is_leaf(self):
-        return len(self.children()) == 0
+        return self.rgt == self.lft + 1
 
     def is_pre_leaf(self):
-        children = self.children()
-        return len(children) > 0 and all(child.is_leaf() for child in children)
+        if self.is_leaf():
+            return False
+        return not self.descendants().filter(level__gt=self.level + 1).exists()
+
+    def engine_alternatives(self):
+        """Return the moves of the engine MultiPV output (as stored by the
+           parser) that are not part of the repertoire
+        """
+        if self.alternatives == "":
+            return list()
+        known = set(child.move_san() for child in self.children())
+        return [
+            alternative
+            for alternative in json.loads(self.alternatives)
+            if alternative["san"] not in known
+        ]
 
     def move_san(self):
         return self.label.split(" ")[-1]
@@ -83,13 +133,13 @@ class Node(models.Model):
         return None
 
     def ancestors(self):
-        result = [self]
-        while True:
-            if result[-1].parent is not None and result[-1].parent.label != "":
-                result.append(result[-1].parent)
-            else:
-                break
-        return result
+        return [self] + list(
+            Node.objects
+            .filter(lft__lt=self.lft, rgt__gt=self.rgt)
+            .exclude(label="")
+            .select_related("parent")
+            .order_by("-lft")
+        )
 
     def color(self):
         target_black = (118, 150, 86)
@@ -128,24 +178,36 @@ class Node(models.Model):
             return reverse("openy:explore_root")
         return reverse("openy:explore_node", kwargs={"uid": self.uid})
 
+    def subtree(self, depth=None):
+        """Return this node and its descendants up to a given relative depth,
+           fetched with a single range query on the nested set interval.
+        """
+        query = Node.objects.filter(lft__gte=self.lft, rgt__lte=self.rgt)
+        if depth is not None:
+            query = query.filter(level__lte=self.level + depth)
+        return query.order_by("uid")
+
     def tree(self, pred=None, succ=None):
         if pred is not None and pred > 0 and self.parent is not None:
             if succ is None:
                 return self.parent.tree(pred - 1, None)
             return self.parent.tree(pred - 1, succ + 1)
+        children = dict()
+        for node in self.subtree(None if succ is None else succ + 1):
+            children.setdefault(node.parent_id, list()).append(node)
         result = dict()
-        result[self] = list()
-        for child in sorted(self.children()):
-            result[self].append(child)
-            child_tree = None
-            if succ is None:
-                _, child_tree = child.tree(None, None)
-            else:
-                if succ > 0:
-                    _, child_tree = child.tree(None, succ - 1)
-            if child_tree is not None:
-                for key, value in child_tree.items():
-                    result[key] = value
+        stack = [(self, succ)]
+        while len(stack) > 0:
+            node, remaining = stack.pop()
+            result[node] = sorted(
+                children.get(node.uid, list()),
+                key=lambda child: evaluation_to_float(child.evaluation)
+            )
+            for child in result[node]:
+                child.parent = node
+            if remaining is None or remaining > 0:
+                for child in reversed(result[node]):
+                    stack.append((child, None if remaining is None else remaining - 1))
         return self, result
 
     def nth_best_move(self, pov):
@@ -178,6 +240,26 @@ def get_days_delta(start, end):
     return time_delta.days + float(time_delta.seconds) / (24. * 3600.)
 
 
+def inactivity_ratio(date_creation, last_try, now):
+    """Time since the last try, relative to the time since creation"""
+    creation_delta = get_days_delta(date_creation, now)
+    if creation_delta <= 0:
+        return 1.
+    if last_try is None:
+        return 1.
+    return get_days_delta(last_try, now) / creation_delta
+
+
+def training_weight(ratios, coefficients):
+    """Weighted average of the (failure, inactivity, ease) ratios of a
+       position training
+    """
+    return sum(
+        coefficient * ratio
+        for coefficient, ratio in zip(coefficients, ratios)
+    ) / sum(coefficients)
+
+
 def elo_winning_probabiliy(gap, spreading):
     return 1 / (1 + 10 ** (-gap / spreading))
 
@@ -186,6 +268,23 @@ def elo_update(gap, outcome, volatility, spreading):
     return volatility * (float(outcome) - elo_winning_probabiliy(gap, spreading))
 
 
+def sm2_update(easiness, interval, repetitions, outcome):
+    """SuperMemo 2 step, with successes graded 4 and failures graded 1.
+       Return the new (easiness, interval in days, repetitions) triplet.
+    """
+    quality = 4 if outcome else 1
+    easiness = max(1.3, easiness + .1 - (5 - quality) * (.08 + (5 - quality) * .02))
+    if not outcome:
+        return easiness, 1., 0
+    if repetitions == 0:
+        interval = 1.
+    elif repetitions == 1:
+        interval = 6.
+    else:
+        interval *= easiness
+    return easiness, interval, repetitions + 1
+
+
 class PositionTraining(models.Model):
 
     exercise = models.OneToOneField(Exercise, on_delete=models.CASCADE, primary_key=True)
@@ -197,20 +296,34 @@ class PositionTraining(models.Model):
     last_try = models.DateTimeField(null=True, blank=True)
     date_creation = models.DateTimeField(auto_now=False, auto_now_add=True)
     elo = models.FloatField(default=1000.)
-
-    def add_try(self, outcome):
-        profile = TrainingProfile.load()
+    due = models.DateTimeField(null=True, blank=True, db_index=True)
+    interval = models.FloatField(default=0.)
+    easiness = models.FloatField(default=2.5)
+    repetitions = models.PositiveIntegerField(default=0)
+
+    def add_try(self, outcome, profile=None):
+        """Record a try. If a training profile is given, saving it is left to
+           the caller, so that a batch of tries saves it once.
+        """
+        save_profile = profile is None
+        if profile is None:
+            profile = TrainingProfile.load()
         elo_gap = profile.elo - self.elo
         profile.elo += elo_update(elo_gap, outcome, profile.elo_volatility, profile.elo_spreading)
         self.elo += elo_update(-elo_gap, not outcome, profile.elo_volatility, profile.elo_spreading)
-        profile.save()
+        if save_profile:
+            profile.save()
         self.tries += 1
         if outcome:
             self.successes += 1
         else:
             self.failures += 1
         self.last_try = timezone.now()
+        self.easiness, self.interval, self.repetitions = sm2_update(
+            self.easiness, self.interval, self.repetitions, outcome)
+        self.due = self.last_try + datetime.timedelta(days=self.interval)
         self.save()
+        TrainingStatistics.record_try(outcome, outcome and self.successes == 1)
 
     def add_success(self):
         self.add_try(True)
@@ -224,22 +337,16 @@ class PositionTraining(models.Model):
         return .5 * (1 +(self.failures - self.successes) / (self.tries + 1))
 
     def get_inactivity_ratio(self):
-        now = timezone.now()
-        creation_delta = get_days_delta(self.date_creation, now)
-        last_try_delta = creation_delta
-        if self.last_try is not None:
-            last_try_delta = get_days_delta(self.last_try, now)
-        return last_try_delta / creation_delta
+        return inactivity_ratio(self.date_creation, self.last_try, timezone.now())
 
     def get_ease_ratio(self):
         return (10. - min(self.node_root.depth() // 2 - 1, 10)) / 10.
 
     def get_training_weight(self, failure_coef=1., inactivity_coef=1., ease_coef=0.):
-        return (
-            failure_coef * self.get_failure_ratio()
-            + inactivity_coef * self.get_inactivity_ratio()
-            + ease_coef * self.get_ease_ratio()
-        ) / (failure_coef + inactivity_coef + ease_coef)
+        return training_weight(
+            (self.get_failure_ratio(), self.get_inactivity_ratio(), self.get_ease_ratio()),
+            (failure_coef, inactivity_coef, ease_coef)
+        )
 
 
 class SingletonModel(models.Model):
@@ -263,9 +370,119 @@ class SingletonModel(models.Model):
 
 class TrainingProfile(SingletonModel):
 
+    RANDOM = "random"
+    SM2 = "sm2"
+    SCHEDULERS = [
+        (RANDOM, "Weighted random"),
+        (SM2, "Spaced repetition (SM-2)"),
+    ]
+
     elo = models.FloatField(default=1000.)
     failure_coef = models.FloatField(default=1.)
     inactivity_coef = models.FloatField(default=1.)
     ease_coef = models.FloatField(default=1.)
     elo_spreading = models.FloatField(default=400)
     elo_volatility = models.FloatField(default=10)
+    scheduler = models.CharField(max_length=10, choices=SCHEDULERS, default=RANDOM)
+
+
+class RepertoireState(SingletonModel):
+
+    generation = models.PositiveIntegerField(default=0)
+    date_update = models.DateTimeField(null=True, blank=True)
+    exercise_generation = models.PositiveIntegerField(default=0)
+
+    @classmethod
+    def bump(cls):
+        """Mark the repertoire as replaced by a new generation"""
+        state = cls.load()
+        state.generation = F("generation") + 1
+        state.date_update = timezone.now()
+        state.save()
+
+    @classmethod
+    def bump_exercises(cls):
+        """Mark the set of position trainings as changed"""
+        cls.load()
+        cls.objects.filter(pk=1).update(exercise_generation=F("exercise_generation") + 1)
+
+
+class TrainingStatistics(SingletonModel):
+
+    """Counters over all position trainings, maintained by each try so that
+       the training page does not aggregate the whole table
+    """
+
+    trainings = models.PositiveIntegerField(default=0)
+    covered = models.PositiveIntegerField(default=0)
+    successes = models.PositiveIntegerField(default=0)
+    failures = models.PositiveIntegerField(default=0)
+    date_update = models.DateTimeField(null=True, blank=True)
+
+    @classmethod
+    def rebuild(cls):
+        """Compute the counters again from the position trainings"""
+        totals = PositionTraining.objects.aggregate(
+            trainings=Count("pk"),
+            covered=Count("pk", filter=Q(successes__gte=1)),
+            successes=Sum("successes"),
+            failures=Sum("failures"),
+        )
+        statistics = cls(**{key: value or 0 for key, value in totals.items()})
+        statistics.date_update = timezone.now()
+        statistics.save()
+        return statistics
+
+    @classmethod
+    def current(cls):
+        """Return the counters, computing them if they were never stored"""
+        statistics = cls.objects.filter(pk=1).first()
+        if statistics is None:
+            statistics = cls.rebuild()
+        return statistics
+
+    @classmethod
+    def record_try(cls, outcome, first_success):
+        """Atomically count a try, rebuilding the counters if missing"""
+        if outcome:
+            changes = {"successes": F("successes") + 1}
+            if first_success:
+                changes["covered"] = F("covered") + 1
+        else:
+            changes = {"failures": F("failures") + 1}
+        changes["date_update"] = timezone.now()
+        if cls.objects.filter(pk=1).update(**changes) == 0:
+            cls.rebuild()
+
+
+class Job(models.Model):
+
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+
+    status = models.CharField(max_length=10, default=RUNNING)
+    phase = models.CharField(max_length=20, default="")
+    processed = models.PositiveIntegerField(default=0)
+    total = models.PositiveIntegerField(null=True, blank=True)
+    error = models.TextField(default="")
+    date_creation = models.DateTimeField(auto_now=False, auto_now_add=True)
+    date_phase = models.DateTimeField(auto_now=False, auto_now_add=True)
+    date_update = models.DateTimeField(auto_now=True)
+
+    def is_running(self):
+        return self.status == Job.RUNNING
+
+    def rate(self):
+        """Number of items processed per second during the current phase"""
+        duration = (timezone.now() - self.date_phase).total_seconds()
+        if duration <= 0:
+            return 0.
+        return self.processed / duration
+
+    def eta(self):
+        """Estimated number of seconds left in the current phase, if known"""
+        rate = self.rate()
+        if self.total is None or rate == 0:
+            return None
+        return max(0, self.total - self.processed) / rate
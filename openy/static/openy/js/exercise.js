@@ -47,7 +47,7 @@ function parseMove(string) {
     return move;
 }
 
-function initExercise(wrapper, boardStatus, startingPosition, moves, firstMove) {
+function initExercise(wrapper, boardStatus, startingPosition, moves, firstMove, onFinish) {
     let exercise = {};
     exercise.wrapper = wrapper;
     exercise.boardStatus = boardStatus;
@@ -60,24 +60,35 @@ function initExercise(wrapper, boardStatus, startingPosition, moves, firstMove)
     exercise.started = false;
     exercise.finished = false;
     exercise.timer = initTimer(wrapper);
-    exercise.startingPosition = startingPosition;
-    exercise.moves = [];
-    exercise.progress = 0;
-    exercise.firstMove = firstMove;
+    exercise.onFinish = onFinish;
     exercise.clickedOnPopup = false;
     exercise.didReceiveUrl = false;
     exercise.receivedUrl = null;
 
-    let movesSplit = moves.split(",");
-    exercise.nothingToAsk = true;
-    for (let i = 0; i < movesSplit.length; i++) {
-        exercise.moves.push(parseMove(movesSplit[i]));
-        exercise.nothingToAsk = exercise.nothingToAsk && !exercise.moves[i].ask;
+    exercise.load = function(startingPosition, moves, firstMove) {
+        this.startingPosition = startingPosition;
+        this.moves = [];
+        this.progress = 0;
+        this.status.started = false;
+        this.status.finished = false;
+        this.status.finishStatus = null;
+        this.boardStatus.disabled = true;
+        let movesSplit = moves.split(",");
+        this.nothingToAsk = true;
+        for (let i = 0; i < movesSplit.length; i++) {
+            this.moves.push(parseMove(movesSplit[i]));
+            this.nothingToAsk = this.nothingToAsk && !this.moves[i].ask;
+        }
+        if (this.nothingToAsk) {
+            console.log("This exercise has nothing to ask...");
+        }
+        if (this.boardStatus.flipped == firstMove) {
+            this.boardStatus.reverse();
+        }
+        this.firstMove = firstMove;
     }
 
-    if (exercise.nothingToAsk) {
-        console.log("This exercise has nothing to ask...");
-    }
+    exercise.load(startingPosition, moves, firstMove);
 
     exercise.start = function() {
         this.wrapper.querySelector(".exercise__start_button").style.display = "none";
@@ -102,6 +113,12 @@ function initExercise(wrapper, boardStatus, startingPosition, moves, firstMove)
         this.status.finished = true;
         this.timer.stop();
         this.boardStatus.disabled = true;
+        if (this.onFinish) {
+            if (this.status.finishStatus == null) {
+                this.onFinish(null, this.progress);
+            }
+            return;
+        }
         let request = new XMLHttpRequest();
         let self = this;
         if (this.status.finishStatus != null) {
@@ -185,6 +202,10 @@ function initExercise(wrapper, boardStatus, startingPosition, moves, firstMove)
     wrapper.querySelectorAll(".exercise_popup").forEach((item, i) => {
         item.querySelector(".exercise_popup__button").addEventListener("click", (event) => {
             event.target.parentNode.classList.remove("show");
+            if (exercise.onFinish) {
+                exercise.onFinish(exercise.status.finishStatus, exercise.progress);
+                return;
+            }
             exercise.clickedOnPopup = true;
             if (exercise.didReceiveUrl) {
                 window.location.href = exercise.receivedUrl;
@@ -192,9 +213,5 @@ function initExercise(wrapper, boardStatus, startingPosition, moves, firstMove)
         });
     });
 
-    if (!exercise.firstMove) {
-        exercise.boardStatus.reverse();
-    }
-
     return exercise;
 }
@@ -1,7 +1,7 @@
 console.log("Echo from explore.js");
 
 
-function createBoardCallback(uid) {
+function createBoardCallback(uid, parentFen) {
     let callback = (fen) => {
         let request = new XMLHttpRequest();
         request.open("POST", findEntryUrl, true);
@@ -13,7 +13,7 @@ function createBoardCallback(uid) {
                 }
             }
         }
-        request.send("csrfmiddlewaretoken=" + csrfToken + "&fen=" + fen.split(" ")[0] + "&uid=" + uid);
+        request.send("csrfmiddlewaretoken=" + csrfToken + "&fen=" + encodeURIComponent(fen) + "&uid=" + uid + "&parent=" + encodeURIComponent(parentFen));
     }
     return callback;
 }
@@ -88,6 +88,6 @@ function setTrainShortcut(trainShortcut, boardStatus) {
         request.onload = function() {
             window.location.href = request.responseURL;
         }
-        request.send("csrfmiddlewaretoken=" + csrfToken + "&fen=" + fen.split(" ")[0]);
+        request.send("csrfmiddlewaretoken=" + csrfToken + "&fen=" + encodeURIComponent(fen));
     });
 }
@@ -1,5 +1,7 @@
 console.log("Echo from repertoire.js");
 
+const SVG_NAMESPACE = "http://www.w3.org/2000/svg";
+
 function createCamera(originalViewBox) {
     camera = {};
     camera.width = parseFloat(originalViewBox[2]);
@@ -28,12 +30,82 @@ function initRepertoireStatus() {
     repertoireStatus.currentViewBox = {};
 
     repertoireStatus.getScale = function(targetRadius) {
-        let radius = parseFloat(this.svg.querySelector(".node circle").getAttribute("r"));
+        let radius = parseFloat(this.svg.querySelector("defs circle").getAttribute("r"));
         let scaleWidth = this.camera.width * targetRadius / (this.div.offsetWidth * radius);
         let scaleHeight = this.camera.height * targetRadius / (this.div.offsetHeight * radius);
         return (scaleWidth < scaleHeight ? scaleWidth : scaleHeight);
     }
 
+    repertoireStatus.setViewBox = function() {
+        this.svg.setAttribute("viewBox", this.camera.toViewBox());
+        if (this.onViewBoxChange) {
+            this.onViewBoxChange();
+        }
+    }
+
+    repertoireStatus.setEventListeners = function() {
+        this.div.addEventListener("wheel", (event) => {
+            event.preventDefault();
+            if (event.deltaY < 0) {
+                this.camera.scale *= 1.2;
+            } else if (event.deltaY > 0) {
+                this.camera.scale /= 1.2;
+            }
+            this.setViewBox();
+        });
+
+        this.div.addEventListener("mousedown", (event) => {
+            this.camera.moving = true;
+            this.camera.moveStartX = event.clientX;
+            this.camera.moveStartY = event.clientY;
+            this.div.style.cursor = "grabbing";
+        });
+        this.div.addEventListener("touchstart", (event) => {
+            this.camera.moving = true;
+            this.camera.moveStartX = event.changedTouches[0].clientX;
+            this.camera.moveStartY = event.changedTouches[0].clientY;
+            this.div.style.cursor = "grabbing";
+        });
+
+        window.addEventListener("mousemove", (event) => {
+            if (this.camera.moving) {
+                let offsetX = event.clientX - this.camera.moveStartX;
+                let offsetY = event.clientY - this.camera.moveStartY;
+                let movementX = 0.001 * this.camera.width / this.camera.scale;
+                let movementY = 0.001 * this.camera.height / this.camera.scale;
+                this.camera.centerX -= (movementX > movementY ? movementX : movementY) * offsetX;
+                this.camera.centerY -= (movementX > movementY ? movementX : movementY) * offsetY;
+                this.camera.moveStartX = event.clientX;
+                this.camera.moveStartY = event.clientY;
+                this.setViewBox();
+            }
+        });
+        window.addEventListener("touchmove", (event) => {
+            if (this.camera.moving) {
+                event.preventDefault();
+                event.stopImmediatePropagation();
+                let offsetX = event.changedTouches[0].clientX - this.camera.moveStartX;
+                let offsetY = event.changedTouches[0].clientY - this.camera.moveStartY;
+                let movementX = 0.001 * this.camera.width / this.camera.scale;
+                let movementY = 0.001 * this.camera.height / this.camera.scale;
+                this.camera.centerX -= (movementX > movementY ? movementX : movementY) * offsetX;
+                this.camera.centerY -= (movementX > movementY ? movementX : movementY) * offsetY;
+                this.camera.moveStartX = event.changedTouches[0].clientX;
+                this.camera.moveStartY = event.changedTouches[0].clientY;
+                this.setViewBox();
+            }
+        });
+
+        window.addEventListener("mouseup", (event) => {
+            this.camera.moving = false;
+            this.div.style.cursor = "grab";
+        });
+        window.addEventListener("touchend", (event) => {
+            this.camera.moving = false;
+            this.div.style.cursor = "grab";
+        });
+    }
+
     repertoireStatus.load = function(url) {
         let request = new XMLHttpRequest();
         request.open("GET", url, true);
@@ -56,82 +128,148 @@ function initRepertoireStatus() {
             this.svg.setAttribute("preserveAspectRatio", "xMidYMid slice");
             this.div.appendChild(this.svg);
 
-            this.div.addEventListener("wheel", (event) => {
-                event.preventDefault();
-                if (event.deltaY < 0) {
-                    this.camera.scale *= 1.2;
-                } else if (event.deltaY > 0) {
-                    this.camera.scale /= 1.2;
-                }
-                this.svg.setAttribute("viewBox", this.camera.toViewBox());
-            });
-
-            this.div.addEventListener("mousedown", (event) => {
-                this.camera.moving = true;
-                this.camera.moveStartX = event.clientX;
-                this.camera.moveStartY = event.clientY;
-                this.div.style.cursor = "grabbing";
-            });
-            this.div.addEventListener("touchstart", (event) => {
-                this.camera.moving = true;
-                this.camera.moveStartX = event.changedTouches[0].clientX;
-                this.camera.moveStartY = event.changedTouches[0].clientY;
-                this.div.style.cursor = "grabbing";
-            });
+            this.setEventListeners();
 
-            window.addEventListener("mousemove", (event) => {
-                if (this.camera.moving) {
-                    let offsetX = event.clientX - this.camera.moveStartX;
-                    let offsetY = event.clientY - this.camera.moveStartY;
-                    let movementX = 0.001 * this.camera.width / this.camera.scale;
-                    let movementY = 0.001 * this.camera.height / this.camera.scale;
-                    this.camera.centerX -= (movementX > movementY ? movementX : movementY) * offsetX;
-                    this.camera.centerY -= (movementX > movementY ? movementX : movementY) * offsetY;
-                    this.camera.moveStartX = event.clientX;
-                    this.camera.moveStartY = event.clientY;
-                    this.svg.setAttribute("viewBox", this.camera.toViewBox());
+            let nodeHref = this.svg.getAttribute("node-href");
+            this.svg.addEventListener("click", (event) => {
+                if (event.target.hasAttribute("uid")) {
+                    window.location.href = nodeHref.replace("UID", event.target.getAttribute("uid"));
                 }
             });
-            window.addEventListener("touchmove", (event) => {
-                if (this.camera.moving) {
-                    event.preventDefault();
-                    event.stopImmediatePropagation();
-                    let offsetX = event.changedTouches[0].clientX - this.camera.moveStartX;
-                    let offsetY = event.changedTouches[0].clientY - this.camera.moveStartY;
-                    let movementX = 0.001 * this.camera.width / this.camera.scale;
-                    let movementY = 0.001 * this.camera.height / this.camera.scale;
-                    this.camera.centerX -= (movementX > movementY ? movementX : movementY) * offsetX;
-                    this.camera.centerY -= (movementX > movementY ? movementX : movementY) * offsetY;
-                    this.camera.moveStartX = event.changedTouches[0].clientX;
-                    this.camera.moveStartY = event.changedTouches[0].clientY;
-                    this.svg.setAttribute("viewBox", this.camera.toViewBox());
-                }
-            });
-
-            window.addEventListener("mouseup", (event) => {
-                this.camera.moving = false;
-                this.div.style.cursor = "grab";
-            });
-            window.addEventListener("touchend", (event) => {
-                this.camera.moving = false;
-                this.div.style.cursor = "grab";
-            });
 
             let targetUid = this.div.getAttribute("target");
-            let targetNode = this.svg.querySelector(".node[uid=\"" + targetUid + "\"] circle");
+            let targetNode = this.svg.querySelector("use[uid=\"" + targetUid + "\"]");
             if (targetNode) {
-                this.camera.centerX = parseFloat(targetNode.getAttribute("cx"));
-                this.camera.centerY = parseFloat(targetNode.getAttribute("cy"));
+                this.camera.centerX = parseFloat(targetNode.getAttribute("x"));
+                this.camera.centerY = parseFloat(targetNode.getAttribute("y"));
                 this.camera.scale = this.getScale(35);
-                this.svg.setAttribute("viewBox", this.camera.toViewBox());
+                this.setViewBox();
             } else {
                 this.camera.scale = 0.8;
-                this.svg.setAttribute("viewBox", this.camera.toViewBox());
+                this.setViewBox();
             }
 
         }
     }
 
+    repertoireStatus.loadTiles = function(layoutUrl, tileUrl) {
+        this.tileUrl = tileUrl;
+        this.tiles = {};
+        this.tileLevel = null;
+        this.tileTimeout = null;
+        let request = new XMLHttpRequest();
+        request.open("GET", layoutUrl, true);
+        let self = this;
+        request.onload = function() {
+            if (request.status == 200) {
+                self.receiveLayout(JSON.parse(request.responseText));
+            }
+        }
+        request.send(null);
+    }
+
+    repertoireStatus.receiveLayout = function(layout) {
+        console.log("Received repertoire layout");
+        this.layout = layout;
+        let bounds = layout.bounds;
+        this.svg = document.createElementNS(SVG_NAMESPACE, "svg");
+        this.svg.setAttribute("height", this.div.offsetHeight + "px");
+        this.svg.setAttribute("width", this.div.offsetWidth + "px");
+        this.svg.setAttribute("preserveAspectRatio", "xMidYMid slice");
+        this.lines = document.createElementNS(SVG_NAMESPACE, "g");
+        this.lines.setAttribute("stroke-width", 2);
+        this.lines.setAttribute("stroke", "black");
+        this.nodes = document.createElementNS(SVG_NAMESPACE, "g");
+        this.nodes.setAttribute("text-anchor", "middle");
+        this.nodes.setAttribute("stroke-width", 5);
+        this.svg.appendChild(this.lines);
+        this.svg.appendChild(this.nodes);
+        this.div.appendChild(this.svg);
+        this.camera = createCamera([bounds[0], bounds[1], bounds[2] - bounds[0], bounds[3] - bounds[1]]);
+        this.camera.scale = 0.8;
+        this.onViewBoxChange = () => {
+            if (this.tileTimeout == null) {
+                this.tileTimeout = setTimeout(() => {
+                    this.tileTimeout = null;
+                    this.updateTiles();
+                }, 100);
+            }
+        }
+        this.setEventListeners();
+        this.setViewBox();
+    }
+
+    repertoireStatus.updateTiles = function() {
+        let viewBox = this.camera.toViewBox().split(" ").map(parseFloat);
+        let zoom = Math.max(this.div.offsetWidth / viewBox[2], this.div.offsetHeight / viewBox[3]);
+        let level = Math.floor(Math.log2(zoom));
+        level = Math.min(Math.max(level, this.layout.min_level), this.layout.max_level);
+        if (level != this.tileLevel) {
+            this.tileLevel = level;
+            this.tiles = {};
+            this.lines.innerHTML = "";
+            this.nodes.innerHTML = "";
+        }
+        let tileSize = this.layout.tile_pixels / Math.pow(2, level);
+        let columnStart = Math.floor(viewBox[0] / tileSize);
+        let columnEnd = Math.floor((viewBox[0] + viewBox[2]) / tileSize);
+        let rowStart = Math.floor(viewBox[1] / tileSize);
+        let rowEnd = Math.floor((viewBox[1] + viewBox[3]) / tileSize);
+        for (let column = columnStart; column <= columnEnd; column++) {
+            for (let row = rowStart; row <= rowEnd; row++) {
+                let key = level + "/" + column + "/" + row;
+                if (key in this.tiles) {
+                    continue;
+                }
+                this.tiles[key] = null;
+                let request = new XMLHttpRequest();
+                request.open("GET", this.tileUrl + "?level=" + level + "&column=" + column + "&row=" + row, true);
+                let self = this;
+                request.onload = function() {
+                    if (request.status == 200 && self.tiles[key] === null) {
+                        self.tiles[key] = JSON.parse(request.responseText);
+                        self.drawTile(self.tiles[key]);
+                    }
+                }
+                request.send(null);
+            }
+        }
+    }
+
+    repertoireStatus.drawTile = function(tile) {
+        let radius = this.layout.radius;
+        tile.nodes.forEach((node) => {
+            if (node.parent != null) {
+                let line = document.createElementNS(SVG_NAMESPACE, "line");
+                line.setAttribute("x1", node.parent[0]);
+                line.setAttribute("y1", node.parent[1]);
+                line.setAttribute("x2", node.x);
+                line.setAttribute("y2", node.y);
+                this.lines.appendChild(line);
+            }
+            let group = document.createElementNS(SVG_NAMESPACE, "g");
+            group.setAttribute("class", "node");
+            group.setAttribute("uid", node.uid);
+            let link = document.createElementNS(SVG_NAMESPACE, "a");
+            link.setAttribute("href", node.href);
+            let circle = document.createElementNS(SVG_NAMESPACE, "circle");
+            circle.setAttribute("cx", node.x);
+            circle.setAttribute("cy", node.y);
+            circle.setAttribute("r", node.hidden > 0 ? 1.5 * radius : radius);
+            circle.setAttribute("fill", node.color);
+            let text = document.createElementNS(SVG_NAMESPACE, "text");
+            text.setAttribute("x", node.x);
+            text.setAttribute("y", node.y);
+            text.setAttribute("fill", "white");
+            text.setAttribute("dy", ".3em");
+            text.textContent = node.hidden > 0 ? node.label + " +" + node.hidden : node.label;
+            link.appendChild(circle);
+            link.appendChild(text);
+            group.appendChild(link);
+            this.nodes.appendChild(group);
+        });
+    }
+
     return repertoireStatus;
 }
 
@@ -144,14 +282,21 @@ function initRepertoire(div, url) {
     if (centerButton) {
         centerButton.addEventListener("click", (event) => {
             let targetUid = div.getAttribute("target");
-            let targetNode = repertoireStatus.svg.querySelector(".node[uid=\"" + targetUid + "\"] circle");
+            let targetNode = repertoireStatus.svg.querySelector("use[uid=\"" + targetUid + "\"]");
             if (targetNode) {
-                repertoireStatus.camera.centerX = parseFloat(targetNode.getAttribute("cx"));
-                repertoireStatus.camera.centerY = parseFloat(targetNode.getAttribute("cy"));
+                repertoireStatus.camera.centerX = parseFloat(targetNode.getAttribute("x"));
+                repertoireStatus.camera.centerY = parseFloat(targetNode.getAttribute("y"));
                 repertoireStatus.camera.scale = repertoireStatus.getScale(35);
-                repertoireStatus.svg.setAttribute("viewBox", repertoireStatus.camera.toViewBox());
+                repertoireStatus.setViewBox();
             }
         });
     }
 
 }
+
+function initTiledRepertoire(div, layoutUrl, tileUrl) {
+    repertoireStatus = initRepertoireStatus();
+    repertoireStatus.div = div;
+    repertoireStatus.loadTiles(layoutUrl, tileUrl);
+    return repertoireStatus;
+}
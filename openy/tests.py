@@ -1,3 +1,553 @@
+import io
+import os
+import sys
+import json
+import random
+import tempfile
+import chess
+import chess.polyglot
 from django.test import TestCase
+from django.utils import timezone
+from . import models
+from .utils import sampler
+from .utils.sampler import FenwickTree
+from .utils.book import write_book, find_child
+from .utils.draw import Position, SvgNode, layout_breadth, layout_tidy
+from .utils.repertoire import clear_repertoire, compute_intervals, iter_records, load_repertoire, merge_repertoire
+from .utils.train import build_trainable_exercises, create_exercises, get_node_coverage, plan_exercises, rebuild_exercises
 
-# Create your tests here.
+
+FIXTURE = [
+    ("e4", "+0.30"),
+    ("e4 e5", "+0.35"),
+    ("e4 e5 Nf3", "+0.30"),
+    ("e4 e5 Nf3 Nc6", "+0.30"),
+    ("e4 e5 Nf3 Nc6 Bb5", "+0.35"),
+    ("e4 e5 Nf3 Nc6 Bc4", "+0.20"),
+    ("e4 e5 Nf3 Nf6", "+0.40"),
+    ("e4 e5 Bc4", "+0.10"),
+    ("e4 c5", "+0.30"),
+    ("e4 c5 Nf3", "+0.30"),
+    ("e4 c5 Nf3 d6", "+0.35"),
+    ("e4 c5 Nf3 d6 d4", "+0.35"),
+    ("e4 c5 c3", "+0.10"),
+    ("d4", "+0.20"),
+    ("d4 Nf6", "+0.25"),
+    ("d4 Nf6 c4", "+0.20"),
+    ("d4 Nf6 c4 e6", "+0.20"),
+    ("d4 Nf6 c4 e6 Nc3", "+0.15"),
+    ("d4 d5", "+0.20"),
+    ("d4 d5 c4", "+0.20"),
+    ("d4 d5 c4 e6", "+0.25"),
+    ("d4 d5 c4 c6", "+0.05"),
+    ("c4", "+0.10"),
+    ("c4 e6", "+0.10"),
+    ("c4 e6 d4", "+0.15"),
+    ("c4 e6 d4 Nf6", "+0.20"),
+    ("c4 e6 d4 Nf6 Nc3", "-0.20"),
+    ("c4 e5", "-0.05"),
+    ("c4 e5 Nc3", "-0.10"),
+    ("c4 e5 Nc3 Nf6", "-0.20"),
+    ("c4 e5 Nc3 Nc6", "+0.05"),
+]
+
+
+def make_records(lines):
+    """Build the records of a repertoire file from (moves, evaluation) pairs,
+       where moves are space separated SAN moves, listed after their parent
+    """
+    records = [{
+        "uid": 0,
+        "fen": chess.STARTING_FEN,
+        "ev": "+0.20",
+        "cmt": "",
+        "p": None,
+        "lbl": "",
+        "line": "",
+    }]
+    uids = {"": 0}
+    for moves, evaluation in lines:
+        board = chess.Board()
+        words = list()
+        label = ""
+        for san in moves.split(" "):
+            if board.turn == chess.WHITE:
+                label = "%d. %s" % (board.fullmove_number, san)
+                words.append(label)
+            else:
+                label = "%d. ... %s" % (board.fullmove_number, san)
+                words.append(san)
+            board.push_san(san)
+        uids[moves] = len(records)
+        records.append({
+            "uid": len(records),
+            "fen": board.fen(),
+            "ev": evaluation,
+            "cmt": "",
+            "p": uids[moves.rpartition(" ")[0]],
+            "lbl": label,
+            "line": " ".join(words),
+        })
+    return records
+
+
+def to_file(records):
+    """Serialize records as an uploaded JSON file"""
+    return io.BytesIO(json.dumps(records).encode("utf8"))
+
+
+def upload(records, merge=False):
+    """Replace the repertoire, or merge into it, and build its exercises, as
+       an upload does
+    """
+    if merge:
+        rebuild_exercises(merge_repertoire(to_file(records)))
+    else:
+        clear_repertoire()
+        load_repertoire(to_file(records))
+        build_trainable_exercises()
+
+
+def exercise_lines():
+    """Return the exercises as a dictionnary mapping (leaf line, root line,
+       moves, color) quadruplets to their number of tries
+    """
+    return {
+        (
+            training.node_leaf.line,
+            training.node_root.line,
+            training.exercise.moves,
+            training.exercise.first_move,
+        ): training.tries
+        for training in models.PositionTraining.objects.select_related(
+            "exercise", "node_leaf", "node_root")
+    }
+
+
+class CoverageTestCase(TestCase):
+
+    def setUp(self):
+        upload(make_records(FIXTURE))
+
+    def test_matches_ancestors(self):
+        expected = {
+            uid: {chess.WHITE: False, chess.BLACK: False}
+            for uid in models.Node.objects.values_list("uid", flat=True)
+        }
+        for training in models.PositionTraining.objects.select_related("exercise", "node_leaf"):
+            for ancestor in training.node_leaf.ancestors():
+                expected[ancestor.uid][training.exercise.first_move] = True
+        coverage = get_node_coverage()
+        self.assertEqual(coverage, expected)
+        for color in [chess.WHITE, chess.BLACK]:
+            self.assertTrue(any(value[color] for value in coverage.values()))
+            self.assertFalse(all(value[color] for value in coverage.values()))
+
+
+class SamplerTestCase(TestCase):
+
+    def setUp(self):
+        upload(make_records(FIXTURE))
+        sampler.SAMPLER.clear()
+
+    def test_refresh_reads_other_processes(self):
+        profile = models.TrainingProfile.load()
+        with sampler.SAMPLER_LOCK:
+            trainings = sampler.get_sampler(profile)
+        training = models.PositionTraining.objects.first()
+        index = trainings.indices[training.exercise_id]
+        weight = trainings.tree.weights[index]
+        # Tries recorded by another process are not reported to this sampler
+        models.PositionTraining.objects.filter(pk=training.pk).update(
+            tries=3,
+            successes=3,
+            last_try=timezone.now(),
+        )
+        with sampler.SAMPLER_LOCK:
+            sampler.get_sampler(profile)
+        self.assertEqual(trainings.tree.weights[index], weight)
+        trainings.date_refresh -= 2 * sampler.SAMPLER_TTL
+        with sampler.SAMPLER_LOCK:
+            self.assertIs(sampler.get_sampler(profile), trainings)
+        self.assertLess(trainings.tree.weights[index], weight)
+
+    def test_sample_more_than_trainings(self):
+        profile = models.TrainingProfile.load()
+        with sampler.SAMPLER_LOCK:
+            trainings = sampler.get_sampler(profile)
+        generator = random.Random(2)
+        for _ in range(200):
+            size = generator.randrange(1, 20)
+            weights = [generator.choice([0., generator.random()]) for _ in range(size)]
+            trainings.exercise_ids = list(range(size))
+            trainings.tree = FenwickTree(weights)
+            chosen = trainings.sample(size + 5)
+            self.assertEqual(len(chosen), len(set(chosen)))
+            self.assertEqual(sorted(chosen), [i for i, weight in enumerate(weights) if weight > 0])
+            self.assertEqual(trainings.tree.weights, weights)
+
+
+    def test_reload_on_exercise_changes(self):
+        profile = models.TrainingProfile.load()
+        with sampler.SAMPLER_LOCK:
+            trainings = sampler.get_sampler(profile)
+        with self.assertNumQueries(1):
+            with sampler.SAMPLER_LOCK:
+                self.assertIs(sampler.get_sampler(profile), trainings)
+        # Rebuilding the last exercise keeps the number of trainings and the
+        # highest exercise ID
+        last = models.PositionTraining.objects.latest("exercise_id")
+        models.Exercise.objects.filter(pk=last.exercise_id).delete()
+        create_exercises([item for item in plan_exercises() if item[0].uid == last.node_leaf_id])
+        self.assertEqual(models.PositionTraining.objects.latest("exercise_id").exercise_id, last.exercise_id)
+        self.assertEqual(models.PositionTraining.objects.count(), len(trainings.exercise_ids))
+        with sampler.SAMPLER_LOCK:
+            reloaded = sampler.get_sampler(profile)
+        self.assertIsNot(reloaded, trainings)
+        self.assertEqual(
+            sorted(reloaded.exercise_ids),
+            sorted(models.PositionTraining.objects.values_list("exercise_id", flat=True))
+        )
+
+
+class BookTestCase(TestCase):
+
+    def setUp(self):
+        upload(make_records(FIXTURE))
+        handle, self.path = tempfile.mkstemp(suffix=".bin")
+        os.close(handle)
+        write_book(self.path, models.Node.objects.all())
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_find_child_through_transpositions(self):
+        nodes = {node.uid: node for node in models.Node.objects.all()}
+        with chess.polyglot.open_reader(self.path) as book:
+            for node in nodes.values():
+                if node.parent_id is None:
+                    continue
+                parent = nodes[node.parent_id]
+                self.assertEqual(find_child(book, parent.board(), node.fen, parent.uid), node.uid)
+        transposed = [
+            node for node in nodes.values()
+            if node.line in ["1. d4 Nf6 2. c4 e6", "1. c4 e6 2. d4 Nf6"]
+        ]
+        self.assertEqual(len(set(node.position for node in transposed)), 1)
+        self.assertTrue(all(not node.is_leaf() for node in transposed))
+
+
+class IntervalsTestCase(TestCase):
+
+    def test_nested_set(self):
+        edges = [(0, None), (5, 0), (2, 0), (3, 2), (4, 2), (1, 5), (7, 1), (6, None), (8, 6)]
+        parents = dict(edges)
+        intervals = compute_intervals(reversed(edges))
+        self.assertEqual(set(intervals), set(parents))
+        values = sorted(value for left, right, _ in intervals.values() for value in (left, right))
+        self.assertEqual(values, list(range(1, 2 * len(edges) + 1)))
+        for uid, (left, right, level) in intervals.items():
+            descendants = [
+                other for other in parents
+                if other != uid and self.is_ancestor(parents, uid, other)
+            ]
+            self.assertEqual(right - left, 2 * len(descendants) + 1)
+            for other in descendants:
+                self.assertTrue(left < intervals[other][0] < intervals[other][1] < right)
+            if parents[uid] is None:
+                self.assertEqual(level, 0)
+            else:
+                self.assertEqual(level, intervals[parents[uid]][2] + 1)
+        self.assertEqual(intervals[0][:2], (1, 14))
+        self.assertEqual(intervals[2][:2], (2, 7))
+        self.assertEqual(intervals[5][:2], (8, 13))
+        self.assertEqual(intervals[7], (10, 11, 3))
+        self.assertEqual(intervals[6][:2], (15, 18))
+
+    @staticmethod
+    def is_ancestor(parents, ancestor, uid):
+        while uid is not None:
+            uid = parents[uid]
+            if uid == ancestor:
+                return True
+        return False
+
+
+class RecordsTestCase(TestCase):
+
+    RECORDS = [
+        {"uid": 0, "p": None, "cmt": "Ouverture, [début] é\u00e8 \"♞\"", "pv": [{"san": "e4"}, []]},
+        {"uid": 1, "p": 0, "cmt": "", "pv": [[1, 2], {"a": "]}, {["}]},
+        {"uid": 2, "p": 1, "cmt": "♜" * 40},
+    ]
+
+    def test_array(self):
+        data = json.dumps(self.RECORDS, ensure_ascii=False, indent=2).encode("utf8")
+        for chunk_size in [1, 3, 7, 1 << 16]:
+            self.assertEqual(list(iter_records(io.BytesIO(data), chunk_size)), self.RECORDS)
+
+    def test_lines(self):
+        data = "\n".join(json.dumps(record, ensure_ascii=False) for record in self.RECORDS).encode("utf8")
+        for chunk_size in [1, 5, 1 << 16]:
+            self.assertEqual(list(iter_records(io.BytesIO(data), chunk_size)), self.RECORDS)
+
+    def test_empty(self):
+        self.assertEqual(list(iter_records(io.BytesIO(b"[]"))), list())
+        self.assertEqual(list(iter_records(io.BytesIO(b""))), list())
+
+    def test_truncated(self):
+        with self.assertRaises(ValueError):
+            list(iter_records(io.BytesIO(b'[{"uid": 0}, {"uid": 1'), 4))
+
+
+class MergeTestCase(TestCase):
+
+    def test_merge_keeps_history(self):
+        upload(make_records(FIXTURE))
+        for training in models.PositionTraining.objects.all():
+            training.add_try(True)
+        fixture = [
+            (moves, "-0.30" if moves == "e4 c5 c3" else evaluation)
+            for moves, evaluation in FIXTURE
+            if not moves.startswith("d4 d5 c4 c6")
+        ] + [
+            ("e4 e5 Nf3 Nc6 Bb5 a6", "+0.30"),
+            ("e4 e5 Nf3 Nc6 Bb5 a6 Ba4", "+0.30"),
+            ("d4 d5 c4 dxc4", "+0.30"),
+            ("d4 d5 c4 dxc4 e3", "+0.30"),
+        ]
+        fixture.sort(key=lambda item: len(item[0].split(" ")))
+        before = exercise_lines()
+        upload(make_records(fixture), merge=True)
+        merged = exercise_lines()
+        upload(make_records(fixture))
+        fresh = exercise_lines()
+        self.assertEqual(set(merged), set(fresh))
+        self.assertNotEqual(set(merged), set(before))
+        kept = set(merged).intersection(before)
+        self.assertGreater(len(kept), 0)
+        for key, tries in merged.items():
+            self.assertEqual(tries, 1 if key in kept else 0)
+        self.assertEqual(models.Node.objects.count(), len(fixture) + 1)
+
+
+class PlanTestCase(TestCase):
+
+    def setUp(self):
+        clear_repertoire()
+        load_repertoire(to_file(make_records(FIXTURE)))
+
+    @staticmethod
+    def plan_per_leaf():
+        """Plan exercises one trainable node at a time, walking up its
+           ancestors, as exercises were first built
+        """
+        tree_root = models.Node.objects.get(parent=None)
+        plan = list()
+        for node in models.Node.objects.order_by("uid"):
+            if not (node.is_leaf() or node.is_pre_leaf()):
+                continue
+            if not node.is_good_position(not node.turn(), -.1):
+                continue
+            moves = list()
+            color = node.turn()
+            root = None
+            for ancestor in node.ancestors():
+                if ancestor.turn() == color and root is None:
+                    if ancestor.is_best_move(not color):
+                        moves.insert(0, "1 " + ancestor.move_uci())
+                    else:
+                        moves.insert(0, "0 " + ancestor.move_uci())
+                        root = ancestor
+                else:
+                    moves.insert(0, "0 " + ancestor.move_uci())
+            if root is None:
+                root = tree_root
+            if root.uid != node.uid:
+                plan.append((node.uid, root.uid, ",".join(moves)))
+        return plan
+
+    def test_same_as_per_leaf(self):
+        plan = [
+            (leaf.uid, root.uid, ",".join(moves))
+            for leaf, root, moves in plan_exercises()
+        ]
+        self.assertEqual(plan, self.plan_per_leaf())
+        colors = set(models.Node.objects.get(uid=uid).turn() for uid, _, _ in plan)
+        self.assertEqual(colors, {chess.WHITE, chess.BLACK})
+
+    def test_selected(self):
+        plan = plan_exercises(lambda node: node.line.startswith("1. c4"))
+        self.assertGreater(len(plan), 0)
+        self.assertEqual(
+            [(leaf.uid, root.uid) for leaf, root, _ in plan],
+            [
+                (leaf, root) for leaf, root, _ in self.plan_per_leaf()
+                if models.Node.objects.get(uid=leaf).line.startswith("1. c4")
+            ]
+        )
+
+
+class LayoutTestCase(TestCase):
+
+    PARAMS = {"radius": 40., "hmargin": 10., "vmargin": 10.}
+
+    UNIT = 2 * PARAMS["radius"] + PARAMS["hmargin"]
+
+    @staticmethod
+    def random_tree(size, seed):
+        """Return a random tree of integers, as a children dictionnary"""
+        generator = random.Random(seed)
+        tree = {0: list()}
+        for node in range(1, size):
+            tree[generator.randrange(max(0, node - 30), node)].append(node)
+            tree[node] = list()
+        return tree
+
+    def layout(self, layout, tree, drawn=None):
+        index = {node: SvgNode(node, self.PARAMS) for node in (tree if drawn is None else drawn)}
+        layout(index[0], tree, index, self.PARAMS)
+        return {node: (svg_node.position.x, svg_node.position.y) for node, svg_node in index.items()}
+
+    def previous_breadth(self, tree, drawn):
+        """Recursive breadth layout, as it was before the layouts were made
+           iterative
+        """
+        index = {node: SvgNode(node, self.PARAMS) for node in drawn}
+
+        def scan_breadth(svg_node):
+            if svg_node.node not in index or len(tree[svg_node.node]) == 0:
+                svg_node.breadth = 1
+                return
+            for child in tree[svg_node.node]:
+                if child in index:
+                    scan_breadth(index[child])
+                    svg_node.breadth += index[child].breadth
+                else:
+                    svg_node.breadth = 1
+
+        def scan_position(svg_node):
+            for i, child in enumerate(tree[svg_node.node]):
+                if child in index:
+                    index[child].position = Position(
+                        svg_node.position.x - .5 * svg_node.width() + .5 * index[child].width()
+                        + sum(index[tree[svg_node.node][j]].width() for j in range(i)),
+                        svg_node.position.y + self.PARAMS["radius"] * 2 + self.PARAMS["vmargin"]
+                    )
+                    scan_position(index[child])
+
+        scan_breadth(index[0])
+        index[0].position = Position(0, 0)
+        scan_position(index[0])
+        return {node: (svg_node.position.x, svg_node.position.y) for node, svg_node in index.items()}
+
+    def test_tidy_no_overlap(self):
+        for seed in range(5):
+            tree = self.random_tree(500, seed)
+            positions = self.layout(layout_tidy, tree)
+            levels = dict()
+            for node, (x, y) in positions.items():
+                levels.setdefault(y, list()).append(x)
+                children = [positions[child][0] for child in tree[node]]
+                if len(children) > 0:
+                    self.assertEqual(children, sorted(children))
+                    self.assertAlmostEqual(x, .5 * (children[0] + children[-1]))
+            for xs in levels.values():
+                xs.sort()
+                for left, right in zip(xs, xs[1:]):
+                    self.assertGreaterEqual(right - left, self.UNIT - 1e-6)
+
+    def test_deep_chain(self):
+        size = 3 * sys.getrecursionlimit()
+        tree = {node: [node + 1] for node in range(size - 1)}
+        tree[size - 1] = list()
+        for layout in [layout_breadth, layout_tidy]:
+            positions = self.layout(layout, tree)
+            self.assertEqual(len(set(x for x, _ in positions.values())), 1)
+            self.assertEqual(
+                max(y for _, y in positions.values()),
+                (size - 1) * (2 * self.PARAMS["radius"] + self.PARAMS["vmargin"])
+            )
+
+    def test_breadth_unchanged(self):
+        for seed in range(5):
+            tree = self.random_tree(300, seed)
+            self.assertEqual(self.layout(layout_breadth, tree), self.previous_breadth(tree, tree))
+            # Nodes below a depth limit are listed as children but not drawn
+            depths = {0: 0}
+            for node in sorted(tree):
+                for child in tree[node]:
+                    depths[child] = depths[node] + 1
+            drawn = [node for node in tree if depths[node] <= 4]
+            self.assertEqual(
+                self.layout(layout_breadth, tree, drawn),
+                self.previous_breadth(tree, drawn)
+            )
+
+
+class FenwickTreeTestCase(TestCase):
+
+    @staticmethod
+    def find(weights, value):
+        """Linear search of the first index whose cumulative weight exceeds
+           the value
+        """
+        total = 0.
+        for index, weight in enumerate(weights):
+            total += weight
+            if total > value:
+                return index
+        return len(weights) - 1
+
+    def test_find(self):
+        generator = random.Random(0)
+        weights = [0., 1., 0., 0., 2.5, .5, 0., 3., 0.]
+        tree = FenwickTree(weights)
+        self.assertAlmostEqual(tree.total(), sum(weights))
+        for value in [0., .5, 1., 1.2, 3.5, 3.9, 4., 6.9, 6.99]:
+            self.assertEqual(tree.find(value), self.find(weights, value))
+        for _ in range(200):
+            index = tree.find(generator.random() * tree.total())
+            self.assertGreater(weights[index], 0)
+
+    def test_update(self):
+        generator = random.Random(1)
+        weights = [generator.choice([0., 0., generator.random()]) for _ in range(37)]
+        tree = FenwickTree(weights)
+        for _ in range(100):
+            index = generator.randrange(len(weights))
+            weights[index] = generator.choice([0., generator.random() * 3])
+            tree.update(index, weights[index])
+            self.assertAlmostEqual(tree.total(), sum(weights))
+            value = generator.random() * sum(weights)
+            self.assertEqual(tree.find(value), self.find(weights, value))
+
+    def test_all_zero(self):
+        tree = FenwickTree([0., 0., 0.])
+        self.assertEqual(tree.total(), 0.)
+        tree.update(1, 2.)
+        self.assertEqual(tree.find(1.), 1)
+        tree.update(1, 0.)
+        self.assertEqual(tree.total(), 0.)
+
+
+class SM2TestCase(TestCase):
+
+    def test_successes(self):
+        self.assertEqual(models.sm2_update(2.5, 0., 0, True), (2.5, 1., 1))
+        self.assertEqual(models.sm2_update(2.5, 1., 1, True), (2.5, 6., 2))
+        self.assertEqual(models.sm2_update(2.5, 6., 2, True), (2.5, 15., 3))
+
+    def test_failure(self):
+        easiness, interval, repetitions = models.sm2_update(2.5, 15., 3, False)
+        self.assertAlmostEqual(easiness, 1.96)
+        self.assertEqual((interval, repetitions), (1., 0))
+
+    def test_easiness_floor(self):
+        easiness = 2.5
+        for _ in range(5):
+            easiness, _, _ = models.sm2_update(easiness, 1., 0, False)
+        self.assertEqual(easiness, 1.3)
+        easiness, interval, _ = models.sm2_update(easiness, 10., 4, True)
+        self.assertEqual(easiness, 1.3)
+        self.assertAlmostEqual(interval, 13.)
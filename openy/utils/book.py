@@ -0,0 +1,113 @@
+"""This module exports the repertoire as a Polyglot opening book, and looks
+   positions up in it. Each entry is keyed by the Zobrist hash of a position
+   and holds one of its repertoire moves; the 'learn' field stores the UID of
+   the node the move leads to. The file is memory-mapped by readers, so
+   lookups are binary searches shared by all worker processes, without any
+   database query.
+"""
+
+import os
+import chess
+import chess.polyglot
+from django.conf import settings
+from .. import models
+
+
+READERS = dict()
+
+
+def get_book_path():
+    """Return the path of the book file, or None if books are disabled"""
+    return getattr(settings, "OPENY_BOOK_PATH", None)
+
+
+def encode_move(board, move):
+    """Encode a move the Polyglot way, castling being king-takes-rook"""
+    to_square = move.to_square
+    if board.is_castling(move):
+        to_square = chess.square(
+            7 if board.is_kingside_castling(move) else 0,
+            chess.square_rank(move.from_square)
+        )
+    promotion = 0
+    if move.promotion is not None:
+        promotion = move.promotion - 1
+    return to_square | (move.from_square << 6) | (promotion << 12)
+
+
+def build_entries(nodes):
+    """Build the sorted list of book entries for a set of nodes. Siblings
+       are weighted by rank, the best move for the side to play getting the
+       highest weight.
+    """
+    nodes = list(nodes)
+    index = {node.uid: node for node in nodes}
+    siblings = dict()
+    for node in nodes:
+        if node.parent_id is not None:
+            siblings.setdefault(node.parent_id, list()).append(node)
+    entries = list()
+    for parent_uid, children in siblings.items():
+        board = index[parent_uid].board()
+        key = chess.polyglot.zobrist_hash(board)
+        children = sorted(
+            children,
+            key=lambda child: models.evaluation_to_float(child.evaluation),
+            reverse=board.turn == chess.WHITE
+        )
+        for rank, child in enumerate(children):
+            try:
+                move = board.parse_san(child.move_san())
+            except ValueError:
+                continue
+            entries.append((key, encode_move(board, move), len(children) - rank, child.uid))
+    entries.sort()
+    return entries
+
+
+def write_book(path, nodes):
+    """Write the book file, atomically replacing any previous one"""
+    temporary_path = path + ".tmp"
+    with open(temporary_path, "wb") as file:
+        for entry in build_entries(nodes):
+            file.write(chess.polyglot.ENTRY_STRUCT.pack(*entry))
+    os.replace(temporary_path, path)
+
+
+def get_book():
+    """Return a memory-mapped reader for the current book file, or None if
+       there is none. Readers are cached per process, and reopened when the
+       file gets replaced.
+    """
+    path = get_book_path()
+    if path is None or not os.path.isfile(path):
+        return None
+    stat = os.stat(path)
+    signature = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+    if path not in READERS or READERS[path][0] != signature:
+        if path in READERS:
+            READERS[path][1].close()
+        READERS[path] = (signature, chess.polyglot.open_reader(path))
+    return READERS[path][1]
+
+
+def find_child(book, board, fen, parent):
+    """Return the UID of the node reached from a given node (its UID and its
+       board) that matches the given FEN (only the piece placement is
+       compared), or None. Entries are shared by the nodes reaching the
+       same position by transposition: if several of them match, the one
+       whose parent is the given node is looked up in the database.
+    """
+    placement = fen.split(" ")[0]
+    uids = list()
+    for entry in book.find_all(board):
+        child = board.copy(stack=False)
+        child.push(entry.move)
+        if child.board_fen() == placement:
+            uids.append(entry.learn)
+    if len(uids) > 1:
+        return models.Node.objects\
+            .filter(uid__in=uids, parent_id=parent)\
+            .values_list("uid", flat=True)\
+            .first()
+    return uids[0] if len(uids) > 0 else None
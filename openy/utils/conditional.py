@@ -0,0 +1,66 @@
+"""This module answers conditional GET requests for pages that only change
+   when a new repertoire is uploaded, or when a training try is recorded.
+   ETags and Last-Modified dates are computed from the repertoire generation
+   and the training statistics, so that a 304 Not Modified response never
+   touches the nodes.
+"""
+
+import hashlib
+import functools
+from django.conf import settings
+from django.utils.cache import patch_cache_control
+from django.views.decorators.http import condition
+from .. import models
+
+
+def get_stamps(request, training):
+    """Return the (ETag, Last-Modified) pair of a request, computed once"""
+    if not hasattr(request, "openy_stamps"):
+        state = models.RepertoireState.load()
+        parts = [
+            str(state.generation),
+            str(request.user.pk),
+            request.COOKIES.get(settings.CSRF_COOKIE_NAME, ""),
+        ]
+        dates = [state.date_update]
+        if training:
+            statistics = models.TrainingStatistics.current()
+            parts.append(repr((
+                statistics.trainings,
+                statistics.covered,
+                statistics.successes,
+                statistics.failures,
+            )))
+            dates.append(statistics.date_update)
+        dates = [date for date in dates if date is not None]
+        request.openy_stamps = (
+            hashlib.sha1("\n".join(parts).encode("utf8")).hexdigest(),
+            max(dates) if len(dates) > 0 else None,
+        )
+    return request.openy_stamps
+
+
+def repertoire_condition(training=None, **cache_control):
+    """Decorate a view whose response only depends on the repertoire, and on
+       the training statistics if training(request) is true. Extra keyword
+       arguments are added to the Cache-Control header, which is private.
+    """
+    def needs_training(request):
+        return training is not None and training(request)
+
+    def etag(request, *args, **kwargs):
+        return get_stamps(request, needs_training(request))[0]
+
+    def last_modified(request, *args, **kwargs):
+        return get_stamps(request, needs_training(request))[1]
+
+    def decorator(view):
+        conditional_view = condition(etag_func=etag, last_modified_func=last_modified)(view)
+
+        @functools.wraps(view)
+        def wrapper(request, *args, **kwargs):
+            response = conditional_view(request, *args, **kwargs)
+            patch_cache_control(response, private=True, **cache_control)
+            return response
+        return wrapper
+    return decorator
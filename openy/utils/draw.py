@@ -1,9 +1,25 @@
-"""This module builds a SVG Tree representation of the nodes in the database."""
+"""This module builds a SVG Tree representation of the nodes in the database.
+   The document is compact: each distinct node style (color, coverage and
+   label) is defined once and instantiated with <use>, coverage strokes are
+   CSS classes, all the edges form a single path, and coordinates are rounded
+   to the pixel. It is generated in chunks, so that it can be streamed.
+"""
 
+from django.urls import reverse
 from .. import models
 from .train import get_node_coverage
 
 
+CHUNK_SIZE = 256
+
+COVERAGE_STYLE = ".cb{stroke:#bf3b3b}.cw{stroke:#3ba7bf}.ck{stroke:#bfae3b}"
+
+
+def short_number(value):
+    """Format a coordinate rounded to the pixel"""
+    return "%d" % round(value)
+
+
 class Position:
     """Simple 2D coordinates wrapper"""
 
@@ -22,66 +38,38 @@ class SvgNode:
         self.position = None
         self.coverage = ""
 
-    def scan_breadth(self, tree, index):
-        """Set its breadth after having computed its children breadth"""
-        if self.node not in index or len(tree[self.node]) == 0:
-            self.breadth = 1
-        else:
-            for child in tree[self.node]:
-                child_svg_node = index.get(child, None)
-                if child_svg_node is not None:
-                    child_svg_node.scan_breadth(tree, index)
-                    self.breadth += child_svg_node.breadth
-                else:
-                    self.breadth = 1
-
-    def scan_position(self, tree, index):
-        """Given that its position is set, sets its children's"""
-        for i, child in enumerate(tree[self.node]):
-            child_svg_node = index.get(child, None)
-            if child_svg_node is not None:
-                child_svg_node.position = Position(
-                    self.position.x - .5 * self.width() + .5 * child_svg_node.width()
-                    + sum(index[tree[self.node][j]].width() for j in range(i)),
-                    self.position.y + self.params["radius"] * 2 + self.params["vmargin"]
-                )
-                child_svg_node.scan_position(tree, index)
-
     def set_coverage(self, index):
         """Set coverage information from a global index"""
         data = index[self.node.uid]
         if data[True] and data[False]:
-            self.coverage = "#bf3b3b"
+            self.coverage = "cb"
         elif data[True]:
-            self.coverage = "#3ba7bf"
+            self.coverage = "cw"
         elif data[False]:
-            self.coverage = "#bfae3b"
+            self.coverage = "ck"
 
     def width(self):
         """Map this node's breadth to its width in pixels"""
         return (self.params["radius"] * 2 + self.params["hmargin"]) * float(self.breadth)
 
-    def svg(self):
-        """Generate the SVG data to plot this node"""
-        template = """
-        <g class="node" uid="{UID}">
-        <a href="{HREF}">
-            <circle stroke="{STROKE_COLOR}" cx="{X}" cy="{Y}" r="{RADIUS}" fill="{NODE_COLOR}" />
-            <text x="{X}" y="{Y}" fill="{TEXT_COLOR}" dy=".3em">{LABEL}</text>
-        </a>
-        </g>
+    def circle_style(self):
+        """Return the (fill, coverage class) pair of this node's circle"""
+        return self.node.color(), self.coverage
+
+    def style(self):
+        """Return everything drawn for this node, apart from its position"""
+        return self.circle_style(), self.node.label.replace(". ...", "...")
+
+    def svg(self, style_id):
+        """Generate the SVG data to plot this node, given the identifier of
+           the definition of its style
         """
-        return template.format(
-            X=self.position.x,
-            Y=self.position.y,
-            RADIUS=self.params["radius"],
-            NODE_COLOR=self.node.color(),
-            TEXT_COLOR="white",
-            LABEL=self.node.label.replace(". ...", "..."),
-            UID=self.node.uid,
-            HREF=self.node.href_short(),
-            STROKE_COLOR=self.coverage,
-        ).strip()
+        return '<use uid="%s" href="#%s" x="%s" y="%s"/>' % (
+            self.node.uid,
+            style_id,
+            short_number(self.position.x),
+            short_number(self.position.y),
+        )
 
 
 class SvgLine:
@@ -93,16 +81,217 @@ class SvgLine:
         self.params = params
 
     def svg(self):
-        """Generate the SVG data to plot this link"""
-        template = """
-        <line x1="{START_X}" y1="{START_Y}" x2="{END_X}" y2="{END_Y}" />
-        """
-        return template.format(
-            START_X=self.start.position.x,
-            START_Y=self.start.position.y,
-            END_X=self.end.position.x,
-            END_Y=self.end.position.y
-        ).strip()
+        """Generate the SVG path data to plot this link"""
+        start_x, start_y = round(self.start.position.x), round(self.start.position.y)
+        return "M%d %dl%d %d" % (
+            start_x,
+            start_y,
+            round(self.end.position.x) - start_x,
+            round(self.end.position.y) - start_y,
+        )
+
+
+def layout_breadth(root, tree, index, params):
+    """Give each leaf its own column, and center each node above the columns
+       of its subtree
+    """
+    order = list()
+    stack = [root]
+    while len(stack) > 0:
+        node = stack.pop()
+        order.append(node)
+        for child in tree.get(node.node, list()):
+            child_svg_node = index.get(child, None)
+            if child_svg_node is not None:
+                stack.append(child_svg_node)
+    for svg_node in reversed(order):
+        svg_node.breadth = 0
+        if len(tree[svg_node.node]) == 0:
+            svg_node.breadth = 1
+        for child in tree[svg_node.node]:
+            child_svg_node = index.get(child, None)
+            if child_svg_node is not None:
+                svg_node.breadth += child_svg_node.breadth
+            else:
+                svg_node.breadth = 1
+    root.position = Position(0, 0)
+    for svg_node in order:
+        offset = 0
+        for child in tree[svg_node.node]:
+            child_svg_node = index.get(child, None)
+            if child_svg_node is None:
+                continue
+            child_svg_node.position = Position(
+                svg_node.position.x - .5 * svg_node.width() + .5 * child_svg_node.width()
+                + offset,
+                svg_node.position.y + params["radius"] * 2 + params["vmargin"]
+            )
+            offset += child_svg_node.width()
+
+
+class TidyNode:
+    """Layout state of a node for the Buchheim, Jünger and Leipert variant of
+       the Reingold-Tilford algorithm
+    """
+
+    __slots__ = ["svg_node", "parent", "children", "number", "prelim", "mod",
+                 "thread", "ancestor", "change", "shift"]
+
+    def __init__(self, svg_node, parent, number):
+        self.svg_node = svg_node
+        self.parent = parent
+        self.children = list()
+        self.number = number
+        self.prelim = 0.
+        self.mod = 0.
+        self.thread = None
+        self.ancestor = self
+        self.change = 0.
+        self.shift = 0.
+
+    def left_sibling(self):
+        if self.parent is None or self.number == 0:
+            return None
+        return self.parent.children[self.number - 1]
+
+    def leftmost_sibling(self):
+        if self.parent is None:
+            return self
+        return self.parent.children[0]
+
+    def next_left(self):
+        if len(self.children) > 0:
+            return self.children[0]
+        return self.thread
+
+    def next_right(self):
+        if len(self.children) > 0:
+            return self.children[-1]
+        return self.thread
+
+
+def tidy_move_subtree(left, right, shift):
+    """Shift the subtree of right, and register the spreading of the shift
+       over the siblings between left and right
+    """
+    subtrees = right.number - left.number
+    right.change -= shift / subtrees
+    right.shift += shift
+    left.change += shift / subtrees
+    right.prelim += shift
+    right.mod += shift
+
+
+def tidy_execute_shifts(node):
+    """Apply the shifts registered among the children of a node"""
+    shift = 0.
+    change = 0.
+    for child in reversed(node.children):
+        child.prelim += shift
+        child.mod += shift
+        change += child.change
+        shift += child.shift + change
+
+
+def tidy_apportion(node, default_ancestor):
+    """Push the subtree of a node away from the subtrees of its left siblings,
+       following their contours. Return the new default ancestor.
+    """
+    left = node.left_sibling()
+    if left is None:
+        return default_ancestor
+    inner_right = outer_right = node
+    inner_left = left
+    outer_left = node.leftmost_sibling()
+    shift_inner_right = inner_right.mod
+    shift_outer_right = outer_right.mod
+    shift_inner_left = inner_left.mod
+    shift_outer_left = outer_left.mod
+    while inner_left.next_right() is not None and inner_right.next_left() is not None:
+        inner_left = inner_left.next_right()
+        inner_right = inner_right.next_left()
+        outer_left = outer_left.next_left()
+        outer_right = outer_right.next_right()
+        outer_right.ancestor = node
+        shift = inner_left.prelim + shift_inner_left\
+            - inner_right.prelim - shift_inner_right + 1
+        if shift > 0:
+            ancestor = default_ancestor
+            if inner_left.ancestor.parent is node.parent:
+                ancestor = inner_left.ancestor
+            tidy_move_subtree(ancestor, node, shift)
+            shift_inner_right += shift
+            shift_outer_right += shift
+        shift_inner_left += inner_left.mod
+        shift_inner_right += inner_right.mod
+        shift_outer_left += outer_left.mod
+        shift_outer_right += outer_right.mod
+    if inner_left.next_right() is not None and outer_right.next_right() is None:
+        outer_right.thread = inner_left.next_right()
+        outer_right.mod += shift_inner_left - shift_outer_right
+    if inner_right.next_left() is not None and outer_left.next_left() is None:
+        outer_left.thread = inner_right.next_left()
+        outer_left.mod += shift_inner_right - shift_outer_left
+        default_ancestor = node
+    return default_ancestor
+
+
+def layout_tidy(root, tree, index, params):
+    """Pack subtrees as close as their contours allow, in linear time. Both
+       walks of the algorithm use explicit stacks instead of recursion.
+    """
+    tidy_root = TidyNode(root, None, 0)
+    stack = [tidy_root]
+    while len(stack) > 0:
+        tidy_node = stack.pop()
+        for child in tree.get(tidy_node.svg_node.node, list()):
+            child_svg_node = index.get(child, None)
+            if child_svg_node is not None:
+                tidy_child = TidyNode(child_svg_node, tidy_node, len(tidy_node.children))
+                tidy_node.children.append(tidy_child)
+                stack.append(tidy_child)
+    default_ancestors = dict()
+    stack = [(tidy_root, 0)]
+    while len(stack) > 0:
+        tidy_node, i = stack.pop()
+        if i == 0 and len(tidy_node.children) > 0:
+            default_ancestors[tidy_node] = tidy_node.children[0]
+        if i > 0:
+            default_ancestors[tidy_node] = tidy_apportion(
+                tidy_node.children[i - 1], default_ancestors[tidy_node])
+        if i < len(tidy_node.children):
+            stack.append((tidy_node, i + 1))
+            stack.append((tidy_node.children[i], 0))
+            continue
+        left = tidy_node.left_sibling()
+        if len(tidy_node.children) == 0:
+            tidy_node.prelim = 0. if left is None else left.prelim + 1
+            continue
+        del default_ancestors[tidy_node]
+        tidy_execute_shifts(tidy_node)
+        midpoint = .5 * (tidy_node.children[0].prelim + tidy_node.children[-1].prelim)
+        if left is None:
+            tidy_node.prelim = midpoint
+        else:
+            tidy_node.prelim = left.prelim + 1
+            tidy_node.mod = tidy_node.prelim - midpoint
+    unit_x = params["radius"] * 2 + params["hmargin"]
+    unit_y = params["radius"] * 2 + params["vmargin"]
+    stack = [(tidy_root, -tidy_root.prelim, 0)]
+    while len(stack) > 0:
+        tidy_node, modifier, depth = stack.pop()
+        tidy_node.svg_node.position = Position(
+            unit_x * (tidy_node.prelim + modifier),
+            unit_y * depth
+        )
+        for tidy_child in tidy_node.children:
+            stack.append((tidy_child, modifier + tidy_node.mod, depth + 1))
+
+
+LAYOUTS = {
+    "breadth": layout_breadth,
+    "tidy": layout_tidy,
+}
 
 
 def get_viewbox(index, params):
@@ -121,8 +310,10 @@ def get_viewbox(index, params):
     )
 
 
-def repertoire_to_svg(params):
-    """Generate the SVG data plotting nodes from the database.
+def repertoire_svg_chunks(params):
+    """Generate the SVG data plotting nodes from the database, as an iterator
+       of chunks. The nodes are fetched and laid out before returning, since
+       the view box depends on all positions.
        Needed parameters are:
        center       Center node UID
        pred         Number of ancestors to include, relative to the center
@@ -134,6 +325,7 @@ def repertoire_to_svg(params):
        lcolor       Line color
        bcolor       Background color (in hexadecimal, without the #)
        coverage     Show nodes coverage (0 (False) or 1 (True))
+       layout       Layout engine, "breadth" (default) or "tidy"
     """
     root, tree = models.Node.objects.get(uid=params["center"]).tree(
         pred=params["pred"],
@@ -148,31 +340,72 @@ def repertoire_to_svg(params):
             child_svg_node = svg_nodes.get(child, None)
             if child_svg_node is not None:
                 svg_lines.append(SvgLine(svg_nodes[parent], child_svg_node, params))
-    svg_nodes[root].scan_breadth(tree, svg_nodes)
-    svg_nodes[root].position = Position(0, 0)
-    svg_nodes[root].scan_position(tree, svg_nodes)
+    layout = LAYOUTS.get(params.get("layout"), layout_breadth)
+    layout(svg_nodes[root], tree, svg_nodes, params)
     if params["coverage"]:
         coverage = get_node_coverage()
         for node in svg_nodes.values():
             node.set_coverage(coverage)
-    template = """
-    <svg xmlns="http://www.w3.org/2000/svg" viewBox="{VIEWBOX}" style="background: #{BG_COLOR}">
-    <g>
-        <g stroke-width="{LINE_WIDTH}" stroke="{LINE_COLOR}">
-        {LINES}
-        </g>
-        <g text-anchor="middle" stroke-width="{STROKE_WIDTH}">
-        {NODES}
-        </g>
-    </g>
-    </svg>
+    header = '<svg xmlns="http://www.w3.org/2000/svg" viewBox="{VIEWBOX}" style="background: #{BG_COLOR}"'\
+        ' node-href="{NODE_HREF}"><style>{STYLE}</style>'
+    edges_header = '<path class="edges" fill="none" stroke-width="{LINE_WIDTH}" stroke="{LINE_COLOR}" d="'
+    nodes_header = '"/><g text-anchor="middle" dominant-baseline="central" fill="white" stroke-width="{STROKE_WIDTH}">'
+    return iter_svg_chunks(
+        header.format(
+            VIEWBOX=get_viewbox(svg_nodes, params),
+            BG_COLOR=params["bcolor"],
+            NODE_HREF=reverse("openy:explore_node", kwargs={"uid": "UID"}),
+            STYLE=COVERAGE_STYLE if params["coverage"] else "",
+        ),
+        edges_header.format(
+            LINE_WIDTH=params["lwidth"],
+            LINE_COLOR=params["lcolor"],
+        ),
+        nodes_header.format(STROKE_WIDTH=params["swidth"]),
+        svg_lines,
+        list(svg_nodes.values()),
+        short_number(params["radius"]),
+    )
+
+
+def iter_svg_chunks(header, edges_header, nodes_header, svg_lines, svg_nodes, radius):
+    """Yield the SVG document by chunks of CHUNK_SIZE elements: the node
+       style definitions first, then the edges, then the nodes
+    """
+    circles = dict()
+    styles = dict()
+    for svg_node in svg_nodes:
+        circle_style, label = svg_node.style()
+        circles.setdefault(circle_style, "c%d" % len(circles))
+        styles.setdefault((circle_style, label), "s%d" % len(styles))
+    yield header + "<defs>"
+    for (fill, coverage), circle_id in circles.items():
+        yield '<circle id="%s" r="%s" fill="%s"%s/>' % (
+            circle_id,
+            radius,
+            fill,
+            ' class="%s"' % coverage if coverage else "",
+        )
+    definitions = list(styles.items())
+    for i in range(0, len(definitions), CHUNK_SIZE):
+        yield "".join(
+            '<g id="%s"><use href="#%s"/><text>%s</text></g>' % (style_id, circles[circle_style], label)
+            for (circle_style, label), style_id in definitions[i:i + CHUNK_SIZE]
+        )
+    yield "</defs>" + edges_header
+    for i in range(0, len(svg_lines), CHUNK_SIZE):
+        yield "".join(line.svg() for line in svg_lines[i:i + CHUNK_SIZE])
+    yield nodes_header
+    for i in range(0, len(svg_nodes), CHUNK_SIZE):
+        yield "".join(
+            svg_node.svg(styles[svg_node.style()])
+            for svg_node in svg_nodes[i:i + CHUNK_SIZE]
+        )
+    yield "</g></svg>"
+
+
+def repertoire_to_svg(params):
+    """Generate the SVG data plotting nodes from the database, as a string.
+       See repertoire_svg_chunks for the parameters.
     """
-    return template.format(
-        NODES="".join(node.svg() for node in svg_nodes.values()),
-        VIEWBOX=get_viewbox(svg_nodes, params),
-        LINES="".join(line.svg() for line in svg_lines),
-        LINE_WIDTH=params["lwidth"],
-        LINE_COLOR=params["lcolor"],
-        BG_COLOR=params["bcolor"],
-        STROKE_WIDTH=params["swidth"],
-    ).strip()
+    return "".join(repertoire_svg_chunks(params))
@@ -0,0 +1,164 @@
+"""This module runs long tasks, such as repertoire uploads, in a background
+   thread of the web server process. Jobs are recorded in the database, which
+   also serves as a lock: only one job may run at a time. Live progress is
+   kept in memory while a phase runs, and saved to the job row from time to
+   time for the other processes. Since the loading phase happens inside a
+   single transaction, the row is written from a separate thread, which has
+   its own database connection. SQLite only allows one writer at a time, so
+   there progress is only visible to the process running the job.
+"""
+
+import os
+import logging
+import datetime
+import threading
+import concurrent.futures
+from django.db import DatabaseError, connection, transaction
+from django.utils import timezone
+from .. import models
+from .book import get_book_path, write_book
+from .repertoire import clear_repertoire, load_repertoire, merge_repertoire
+from .train import build_trainable_exercises, rebuild_exercises
+
+
+LOGGER = logging.getLogger(__name__)
+
+EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+PROGRESS = dict()
+
+PROGRESS_LOCK = threading.Lock()
+
+PROGRESS_EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+PROGRESS_INTERVAL = datetime.timedelta(seconds=1)
+
+JOB_TIMEOUT = datetime.timedelta(hours=1)
+
+
+def start_upload(path, merge):
+    """Schedule the upload of a repertoire file, which is deleted once done.
+       Return the job, or None if another job is already running.
+    """
+    models.RepertoireState.load()
+    with transaction.atomic():
+        models.RepertoireState.objects.select_for_update().get(pk=1)
+        models.Job.objects.filter(
+            status=models.Job.RUNNING,
+            date_update__lt=timezone.now() - JOB_TIMEOUT
+        ).update(status=models.Job.FAILED, error="Timed out")
+        if models.Job.objects.filter(status=models.Job.RUNNING).exists():
+            return None
+        job = models.Job.objects.create(phase="queued")
+    EXECUTOR.submit(run_upload, job.pk, path, merge)
+    return job
+
+
+def set_phase(job_id, phase, total=None):
+    """Record the beginning of a new job phase"""
+    with PROGRESS_LOCK:
+        PROGRESS.pop(job_id, None)
+    models.Job.objects.filter(pk=job_id).update(
+        phase=phase,
+        processed=0,
+        total=total,
+        date_phase=timezone.now(),
+        date_update=timezone.now(),
+    )
+
+
+def save_progress(job_id, phase, processed, total):
+    """Write the progress of a job phase to its row, unless the job moved
+       on to another phase. Runs on the progress thread.
+    """
+    try:
+        models.Job.objects.filter(pk=job_id, phase=phase).update(
+            processed=processed,
+            total=total,
+            date_update=timezone.now(),
+        )
+    except DatabaseError:
+        LOGGER.warning("Could not save the progress of job %d", job_id, exc_info=True)
+    finally:
+        connection.close()
+
+
+def report_progress(job_id, phase):
+    """Return a callback storing the progress of a job phase in memory, and
+       in the job row at most every PROGRESS_INTERVAL, skipping a write while
+       the previous one is pending
+    """
+    pending = {"future": None, "date": None}
+
+    def callback(processed, total):
+        with PROGRESS_LOCK:
+            PROGRESS[job_id] = (processed, total)
+        now = timezone.now()
+        if pending["future"] is not None and not pending["future"].done():
+            return
+        if pending["date"] is not None and now - pending["date"] < PROGRESS_INTERVAL:
+            return
+        pending["date"] = now
+        if connection.vendor == "sqlite":
+            return
+        pending["future"] = PROGRESS_EXECUTOR.submit(save_progress, job_id, phase, processed, total)
+    return callback
+
+
+def run_upload(job_id, path, merge):
+    """Load a repertoire file, then write the book and build exercises"""
+    try:
+        merge = merge and models.Node.objects.exists()
+        set_phase(job_id, "loading")
+        with open(path, "rb") as file:
+            with transaction.atomic():
+                if merge:
+                    regions = merge_repertoire(file, callback=report_progress(job_id, "loading"))
+                else:
+                    clear_repertoire()
+                    load_repertoire(file, callback=report_progress(job_id, "loading"))
+                models.RepertoireState.bump()
+        if get_book_path() is not None:
+            set_phase(job_id, "book")
+            write_book(get_book_path(), models.Node.objects.all())
+        set_phase(job_id, "exercises")
+        if merge:
+            rebuild_exercises(regions)
+        else:
+            build_trainable_exercises()
+        models.TrainingStatistics.rebuild()
+        set_phase(job_id, "")
+        models.Job.objects.filter(pk=job_id).update(status=models.Job.DONE)
+    except Exception as error:
+        LOGGER.exception("Job %d failed", job_id)
+        models.Job.objects.filter(pk=job_id).update(
+            status=models.Job.FAILED,
+            error=str(error),
+            date_update=timezone.now(),
+        )
+    finally:
+        with PROGRESS_LOCK:
+            PROGRESS.pop(job_id, None)
+        os.remove(path)
+        connection.close()
+
+
+def describe_job(job):
+    """Serialize a job for the progress endpoint. The progress saved in the
+       job row is replaced by the live one if the job runs within this
+       process.
+    """
+    with PROGRESS_LOCK:
+        if job.pk in PROGRESS:
+            job.processed, job.total = PROGRESS[job.pk]
+    eta = job.eta() if job.is_running() else None
+    return {
+        "id": job.pk,
+        "status": job.status,
+        "phase": job.phase,
+        "processed": job.processed,
+        "total": job.total,
+        "rate": round(job.rate(), 1) if job.is_running() else None,
+        "eta": None if eta is None else round(eta, 1),
+        "error": job.error,
+    }
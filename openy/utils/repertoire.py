@@ -0,0 +1,283 @@
+"""This module gathers tools to load a repertoire into the database"""
+
+import json
+import time
+import codecs
+import logging
+import itertools
+from django.db import connection
+from django.db.models import Q
+from django.template.defaultfilters import slugify
+import chess
+from .. import models
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+def compute_intervals(edges):
+    """Number the repertoire tree as a nested set. Given an iterable of
+       (uid, parent uid) pairs, return a dictionnary mapping each node UID to
+       its (left, right, level) triplet. Siblings are visited in UID order, so
+       that left values follow the order of the original notes.
+    """
+    children = dict()
+    roots = list()
+    for uid, parent in edges:
+        if parent is None:
+            roots.append(uid)
+        else:
+            children.setdefault(parent, list()).append(uid)
+    intervals = dict()
+    lefts = dict()
+    counter = 0
+    stack = [(uid, 0, False) for uid in sorted(roots, reverse=True)]
+    while len(stack) > 0:
+        uid, level, visited = stack.pop()
+        counter += 1
+        if visited:
+            intervals[uid] = (lefts.pop(uid), counter, level)
+            continue
+        lefts[uid] = counter
+        stack.append((uid, level, True))
+        for child in sorted(children.get(uid, list()), reverse=True):
+            stack.append((child, level + 1, False))
+    return intervals
+
+
+def iter_records(file, chunk_size=2 ** 16):
+    """Iterate over the objects of a JSON array, or of newline-delimited JSON,
+       reading and decoding the file chunk by chunk
+    """
+    decoder = json.JSONDecoder()
+    reader = codecs.getreader("utf8")(file)
+    buffer = ""
+    position = 0
+    eof = False
+    while True:
+        while position < len(buffer) and buffer[position] in " \t\r\n,[]":
+            position += 1
+        if position < len(buffer):
+            try:
+                record, end = decoder.raw_decode(buffer, position)
+            except ValueError:
+                if eof:
+                    raise
+            else:
+                position = end
+                yield record
+                continue
+        elif eof:
+            return
+        chunk = reader.read(chunk_size)
+        eof = chunk == ""
+        buffer = buffer[position:] + chunk
+        position = 0
+
+
+def clear_repertoire():
+    """Delete the repertoire along with the exercises built from it. Plain
+       DELETE statements are issued, since the ORM deletion collector would
+       walk the whole tree in Python to cascade over the parent relation.
+       Must run within a transaction: foreign keys are checked at commit.
+    """
+    exercise = models.Exercise._meta
+    training = models.PositionTraining._meta
+    quote = connection.ops.quote_name
+    with connection.cursor() as cursor:
+        cursor.execute("DELETE FROM %s WHERE %s IN (SELECT %s FROM %s)" % (
+            quote(exercise.db_table),
+            quote(exercise.pk.column),
+            quote(training.get_field("exercise").column),
+            quote(training.db_table),
+        ))
+        cursor.execute("DELETE FROM %s" % quote(training.db_table))
+        cursor.execute("DELETE FROM %s" % quote(models.Node._meta.db_table))
+    models.RepertoireState.bump_exercises()
+
+
+def record_to_node(record, uid, parent, interval):
+    """Build a node from an uploaded record, given its UID, its parent UID
+       and its nested set interval
+    """
+    return models.Node(
+        uid=uid,
+        fen=record["fen"],
+        evaluation=record["ev"],
+        comment=record["cmt"],
+        label=record["lbl"],
+        parent_id=parent,
+        line=record["line"],
+        slug=slugify(record["line"]),
+        lft=interval[0],
+        rgt=interval[1],
+        level=interval[2],
+        position=models.position_key(chess.Board(record["fen"])),
+        alternatives=json.dumps(record["pv"]) if "pv" in record else "",
+    )
+
+
+def delete_nodes(uids, batch_size=500):
+    """Delete a set of nodes along with the exercises built on them. Nodes
+       are deleted with plain DELETE statements, as in clear_repertoire.
+    """
+    uids = list(uids)
+    table = models.Node._meta
+    quote = connection.ops.quote_name
+    for i in range(0, len(uids), batch_size):
+        batch = uids[i:i + batch_size]
+        models.Exercise.objects.filter(
+            Q(positiontraining__node_leaf__in=batch) | Q(positiontraining__node_root__in=batch)
+        ).delete()
+        with connection.cursor() as cursor:
+            cursor.execute("DELETE FROM %s WHERE %s IN (%s)" % (
+                quote(table.db_table),
+                quote(table.pk.column),
+                ", ".join(["%s"] * len(batch)),
+            ), batch)
+    if len(uids) > 0:
+        models.RepertoireState.bump_exercises()
+
+
+def load_repertoire(file, batch_size=1000, callback=None):
+    """Insert the nodes of an uploaded repertoire file in batches. The file
+       is read twice: a first pass collects the tree edges to number it as a
+       nested set, the second one creates the nodes. Memory does not grow
+       with the size of the nodes. If given, the callback is called after
+       each batch with the number of processed nodes and the total. Return
+       the number of inserted nodes.
+    """
+    time_start = time.time()
+    intervals = compute_intervals(
+        (record["uid"], record["p"]) for record in iter_records(file)
+    )
+    file.seek(0)
+    records = iter_records(file)
+    total = 0
+    while True:
+        batch = list(itertools.islice(records, batch_size))
+        if len(batch) == 0:
+            break
+        models.Node.objects.bulk_create([
+            record_to_node(record, record["uid"], record["p"], intervals[record["uid"]])
+            for record in batch
+        ])
+        total += len(batch)
+        if callback is not None:
+            callback(total, len(intervals))
+    duration = time.time() - time_start
+    LOGGER.info(
+        "Loaded %d nodes in %.2fs (%.0f nodes/s)",
+        total,
+        duration,
+        total / duration if duration > 0 else 0
+    )
+    return total
+
+
+MERGED_FIELDS = [
+    "parent",
+    "fen",
+    "evaluation",
+    "comment",
+    "label",
+    "line",
+    "lft",
+    "rgt",
+    "level",
+    "position",
+    "alternatives",
+]
+
+
+def merged_values(node):
+    """Return the values of the merged fields of a node, for comparison"""
+    return [
+        getattr(node, models.Node._meta.get_field(field).attname)
+        for field in MERGED_FIELDS
+    ]
+
+
+def merge_repertoire(file, batch_size=1000, callback=None):
+    """Merge an uploaded repertoire file into the current one. Nodes are
+       matched by slug: matched nodes keep their UID (hence their exercises)
+       and are only updated if they changed, new nodes are inserted and
+       missing ones are deleted. The nested set is numbered after the order
+       of the file. The callback, if any, is called as in load_repertoire.
+       Return the (left, right) intervals of the subtrees where exercises
+       must be rebuilt.
+    """
+    time_start = time.time()
+    existing = dict()
+    for node in models.Node.objects.all().iterator():
+        existing[node.slug] = (node.uid, merged_values(node))
+    slugs = dict()
+    edges = list()
+    for record in iter_records(file):
+        slugs[record["uid"]] = slugify(record["line"])
+        edges.append((record["uid"], record["p"]))
+    intervals = compute_intervals(edges)
+    next_uid = max((uid for uid, _ in existing.values()), default=-1) + 1
+    uids = dict()
+    for slug in slugs.values():
+        if slug in existing:
+            uids[slug] = existing[slug][0]
+        else:
+            uids[slug] = next_uid
+            next_uid += 1
+    kept = set(uids.values())
+    touched = set()
+    deleted = list()
+    for slug, (uid, values) in existing.items():
+        if slug not in uids:
+            deleted.append(uid)
+            touched.add(values[0])
+    delete_nodes(deleted)
+    file.seek(0)
+    records = iter_records(file)
+    processed = created = updated = 0
+    while True:
+        batch = list(itertools.islice(records, batch_size))
+        if len(batch) == 0:
+            break
+        creations = list()
+        updates = list()
+        for record in batch:
+            slug = slugs[record["uid"]]
+            parent = None if record["p"] is None else uids[slugs[record["p"]]]
+            node = record_to_node(record, uids[slug], parent, intervals[record["uid"]])
+            values = merged_values(node)
+            if slug not in existing:
+                creations.append(node)
+                touched.add(parent)
+            elif values != existing[slug][1]:
+                updates.append(node)
+                # Exercises only depend on the parent, position and evaluation
+                if values[:3] != existing[slug][1][:3]:
+                    touched.add(parent)
+        models.Node.objects.bulk_create(creations)
+        models.Node.objects.bulk_update(updates, MERGED_FIELDS)
+        created += len(creations)
+        updated += len(updates)
+        processed += len(batch)
+        if callback is not None:
+            callback(processed, len(slugs))
+    tree = {
+        uid: (parent, lft, rgt)
+        for uid, parent, lft, rgt in models.Node.objects.values_list("uid", "parent_id", "lft", "rgt")
+    }
+    regions = set()
+    for uid in touched.intersection(kept):
+        if tree[uid][0] is not None:
+            uid = tree[uid][0]
+        regions.add(tree[uid][1:])
+    duration = time.time() - time_start
+    LOGGER.info(
+        "Merged %d nodes in %.2fs: %d created, %d updated, %d deleted",
+        len(uids),
+        duration,
+        created,
+        updated,
+        len(deleted)
+    )
+    return sorted(regions)
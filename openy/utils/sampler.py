@@ -0,0 +1,241 @@
+"""This module picks position trainings at random, according to their training
+   weights. Weights are kept in memory, in a Fenwick tree of prefix sums, so
+   that picking an exercise or changing the weight of one is O(log n). The
+   ratios making up each weight are kept as well, so that weights are computed
+   again without any query when the profile coefficients change, or when time
+   passes (the inactivity ratio grows with it). Tries are reported to the
+   sampler of the process recording them; the other processes read them
+   from the database when their sampler gets refreshed.
+
+   Alternatively, the training profile may select a spaced repetition
+   scheduler, which picks the exercises that are due first, using the index
+   on their due date.
+"""
+
+import random
+import datetime
+import threading
+from django.utils import timezone
+from .. import models
+
+
+SAMPLER = dict()
+
+SAMPLER_LOCK = threading.Lock()
+
+SAMPLER_TTL = datetime.timedelta(minutes=1)
+
+
+class FenwickTree:
+
+    """Prefix sums of a vector of non-negative weights, with O(log n) point
+       updates and prefix sum searches
+    """
+
+    def __init__(self, weights):
+        self.weights = list(weights)
+        self.size = len(self.weights)
+        self.tree = [0.] + self.weights
+        for i in range(1, self.size + 1):
+            parent = i + (i & -i)
+            if parent <= self.size:
+                self.tree[parent] += self.tree[i]
+
+    def update(self, index, weight):
+        """Set the weight at a given index"""
+        delta = weight - self.weights[index]
+        self.weights[index] = weight
+        i = index + 1
+        while i <= self.size:
+            self.tree[i] += delta
+            i += i & -i
+
+    def total(self):
+        """Return the sum of all weights"""
+        total = 0.
+        i = self.size
+        while i > 0:
+            total += self.tree[i]
+            i -= i & -i
+        return total
+
+    def find(self, value):
+        """Return the first index whose cumulative weight exceeds the value"""
+        index = 0
+        step = 1 << self.size.bit_length()
+        while step > 0:
+            if index + step <= self.size and self.tree[index + step] <= value:
+                index += step
+                value -= self.tree[index]
+            step >>= 1
+        return min(index, self.size - 1)
+
+
+class TrainingSampler:
+
+    """Weighted random choice among all position trainings"""
+
+    def __init__(self, signature):
+        self.signature = signature
+        self.exercise_ids = list()
+        self.indices = dict()
+        self.ratios = list()
+        trainings = models.PositionTraining.objects.select_related("node_root")
+        for training in trainings.only(
+                "exercise", "successes", "failures", "tries", "last_try",
+                "date_creation", "node_root__fen"):
+            self.indices[training.exercise_id] = len(self.exercise_ids)
+            self.exercise_ids.append(training.exercise_id)
+            self.ratios.append((
+                training.get_failure_ratio(),
+                training.date_creation,
+                training.last_try,
+                training.get_ease_ratio(),
+            ))
+        self.coefficients = None
+        self.tree = None
+        self.date_refresh = None
+
+    def weight(self, index, now):
+        failure_ratio, date_creation, last_try, ease_ratio = self.ratios[index]
+        return models.training_weight(
+            (failure_ratio, models.inactivity_ratio(date_creation, last_try, now), ease_ratio),
+            self.coefficients
+        )
+
+    def read(self, training):
+        """Store the ratios of a training whose statistics changed, and
+           return its index, or None if the training is unknown
+        """
+        index = self.indices.get(training.exercise_id)
+        if index is not None:
+            self.ratios[index] = (
+                training.get_failure_ratio(),
+                training.date_creation,
+                training.last_try,
+                self.ratios[index][3],
+            )
+        return index
+
+    def refresh(self, coefficients):
+        """Compute all weights again. Trainings tried since the previous
+           refresh are read again first, since other processes may have
+           recorded tries. The overlap covers tries committed late.
+        """
+        now = timezone.now()
+        if self.date_refresh is not None:
+            trainings = models.PositionTraining.objects.filter(
+                last_try__gte=self.date_refresh - SAMPLER_TTL)
+            for training in trainings.only(
+                    "exercise", "successes", "failures", "tries", "last_try",
+                    "date_creation"):
+                self.read(training)
+        self.coefficients = coefficients
+        self.date_refresh = now
+        self.tree = FenwickTree(
+            self.weight(index, self.date_refresh)
+            for index in range(len(self.ratios))
+        )
+
+    def update(self, training):
+        """Update the weight of a training whose statistics changed"""
+        index = self.read(training)
+        if index is not None:
+            self.tree.update(index, self.weight(index, timezone.now()))
+
+    def choose(self):
+        """Return a random exercise ID, or None if there is no training"""
+        total = self.tree.total()
+        if total <= 0:
+            return None
+        return self.exercise_ids[self.tree.find(random.random() * total)]
+
+    def sample(self, count):
+        """Return up to count distinct random exercise IDs. Chosen weights are
+           set to zero while sampling, then restored. Once all positive
+           weights are chosen, rounding errors may leave a small positive
+           total: sampling stops as soon as a null weight gets picked.
+        """
+        chosen = list()
+        for _ in range(count):
+            total = self.tree.total()
+            if total <= 0:
+                break
+            index = self.tree.find(random.random() * total)
+            if self.tree.weights[index] <= 0:
+                break
+            chosen.append((index, self.tree.weights[index]))
+            self.tree.update(index, 0.)
+        for index, weight in chosen:
+            self.tree.update(index, weight)
+        return [self.exercise_ids[index] for index, _ in chosen]
+
+
+def get_sampler(profile):
+    """Return the sampler of this process, which is reloaded when the set of
+       trainings changes (as told by the exercise generation), and refreshed
+       when the profile coefficients change or when it gets too old. Must be
+       called with the sampler lock held.
+    """
+    signature = models.RepertoireState.load().exercise_generation
+    coefficients = (profile.failure_coef, profile.inactivity_coef, profile.ease_coef)
+    sampler = SAMPLER.get("trainings")
+    if sampler is None or sampler.signature != signature:
+        sampler = TrainingSampler(signature)
+        SAMPLER["trainings"] = sampler
+    if sampler.coefficients != coefficients or timezone.now() - sampler.date_refresh > SAMPLER_TTL:
+        sampler.refresh(coefficients)
+    return sampler
+
+
+def choose_due_exercises(profile, count=1, window=10):
+    """Pick the exercises due for the longest time, then new ones, then the
+       next ones to come due. Exercises due the same day are sorted by their
+       failure and ease ratios, among a few extra candidates.
+    """
+    now = timezone.now()
+    trainings = models.PositionTraining.objects.select_related("node_root")
+    candidates = list()
+    for rank, queryset in enumerate([
+            trainings.filter(due__lte=now).order_by("due"),
+            trainings.filter(due=None),
+            trainings.filter(due__gt=now).order_by("due")]):
+        if len(candidates) >= count:
+            break
+        batch = list(queryset[:count + window])
+        for training in batch:
+            day = 0
+            if training.due is not None:
+                day = (training.due - batch[0].due) // datetime.timedelta(days=1)
+            score = profile.failure_coef * training.get_failure_ratio()\
+                + profile.ease_coef * training.get_ease_ratio()
+            candidates.append(((rank, day, -score), training.exercise_id))
+    candidates.sort(key=lambda candidate: candidate[0])
+    return [exercise_id for _, exercise_id in candidates[:count]]
+
+
+def choose_exercises(count):
+    """Pick the IDs of up to count distinct exercises to train"""
+    profile = models.TrainingProfile.load()
+    if profile.scheduler == models.TrainingProfile.SM2:
+        return choose_due_exercises(profile, count)
+    with SAMPLER_LOCK:
+        return get_sampler(profile).sample(count)
+
+
+def choose_exercise():
+    """Pick the ID of an exercise to train, or None if there is none"""
+    profile = models.TrainingProfile.load()
+    if profile.scheduler == models.TrainingProfile.SM2:
+        chosen = choose_due_exercises(profile)
+        return chosen[0] if len(chosen) > 0 else None
+    with SAMPLER_LOCK:
+        return get_sampler(profile).choose()
+
+
+def update_training(training):
+    """Report that the statistics of a position training changed"""
+    with SAMPLER_LOCK:
+        sampler = SAMPLER.get("trainings")
+        if sampler is not None and sampler.tree is not None:
+            sampler.update(training)
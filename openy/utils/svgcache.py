@@ -0,0 +1,155 @@
+"""This module caches the SVG drawings of the repertoire. Drawings are keyed
+   by their parameters and by the repertoire generation, which every upload
+   bumps, so that stale drawings are never served. Drawings showing the
+   training coverage are also keyed by the training statistics, which change
+   with every try. A bounded LRU cache is kept in memory, and if the
+   OPENY_SVG_CACHE_DIR setting is defined, drawings are also written to that
+   directory, shared by all worker processes. Drawings are streamed: they are
+   stored while being sent, and drawings too large for the memory tier are
+   only stored on disk.
+"""
+
+import os
+import hashlib
+import tempfile
+import threading
+import collections
+from django.conf import settings
+from .. import models
+from .draw import repertoire_svg_chunks
+
+
+SVG_CACHE = collections.OrderedDict()
+
+SVG_CACHE_LOCK = threading.Lock()
+
+DISK_CHUNK_SIZE = 1 << 16
+
+
+def get_cache_size():
+    """Return the maximum number of drawings kept in memory"""
+    return getattr(settings, "OPENY_SVG_CACHE_SIZE", 32)
+
+
+def get_entry_size():
+    """Return the size in bytes of the largest drawing kept in memory"""
+    return getattr(settings, "OPENY_SVG_CACHE_ENTRY_SIZE", 1 << 20)
+
+
+def get_cache_dir():
+    """Return the directory of the disk cache, or None if it is disabled"""
+    return getattr(settings, "OPENY_SVG_CACHE_DIR", None)
+
+
+def get_cache_key(params):
+    """Return the generation of the repertoire and a hash of everything else
+       the drawing depends on
+    """
+    generation = models.RepertoireState.load().generation
+    parts = [repr(sorted(params.items()))]
+    if params["coverage"]:
+        statistics = models.TrainingStatistics.current()
+        parts.append(repr((
+            statistics.trainings,
+            statistics.covered,
+            statistics.successes,
+            statistics.failures,
+        )))
+    return generation, hashlib.sha1("\n".join(parts).encode("utf8")).hexdigest()
+
+
+def get_disk_path(generation, digest):
+    """Return the path of a drawing in the disk cache"""
+    return os.path.join(get_cache_dir(), "%d-%s.svg" % (generation, digest))
+
+
+def remove_stale_files(generation):
+    """Remove the drawings of previous generations from the disk cache"""
+    directory = get_cache_dir()
+    prefix = "%d-" % generation
+    for filename in os.listdir(directory):
+        if filename.endswith(".svg") and not filename.startswith(prefix):
+            try:
+                os.remove(os.path.join(directory, filename))
+            except FileNotFoundError:
+                pass
+
+
+def store_in_memory(key, svg):
+    """Add a drawing to the memory tier, dropping the least recently used
+       ones and those of previous generations
+    """
+    with SVG_CACHE_LOCK:
+        for stale in [other for other in SVG_CACHE if other[0] != key[0]]:
+            del SVG_CACHE[stale]
+        SVG_CACHE[key] = svg
+        SVG_CACHE.move_to_end(key)
+        while len(SVG_CACHE) > get_cache_size():
+            SVG_CACHE.popitem(last=False)
+
+
+def iter_disk_cache(file):
+    """Yield the content of an opened disk cache file by chunks"""
+    with file:
+        while True:
+            chunk = file.read(DISK_CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+
+
+def iter_and_store(key, chunks):
+    """Yield the chunks of a new drawing, while storing it on disk if the
+       disk tier is enabled, and in memory if it is small enough
+    """
+    directory = get_cache_dir()
+    file, path = None, None
+    if directory is not None:
+        os.makedirs(directory, exist_ok=True)
+        handle, path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        file = os.fdopen(handle, "w", encoding="utf8")
+    kept, size = list(), 0
+    try:
+        for chunk in chunks:
+            if file is not None:
+                file.write(chunk)
+            if kept is not None:
+                size += len(chunk)
+                kept.append(chunk)
+                if size > get_entry_size():
+                    kept = None
+            yield chunk
+    except BaseException:
+        if file is not None:
+            file.close()
+            os.remove(path)
+        raise
+    if file is not None:
+        file.close()
+        os.replace(path, get_disk_path(*key))
+        remove_stale_files(key[0])
+    if kept is not None:
+        store_in_memory(key, "".join(kept))
+
+
+def iter_cached_repertoire_svg(params):
+    """Same as repertoire_svg_chunks, but served from the cache when possible"""
+    key = get_cache_key(params)
+    with SVG_CACHE_LOCK:
+        svg = SVG_CACHE.get(key)
+        if svg is not None:
+            SVG_CACHE.move_to_end(key)
+            return iter([svg])
+    if get_cache_dir() is not None:
+        try:
+            file = open(get_disk_path(*key), "r", encoding="utf8")
+        except FileNotFoundError:
+            pass
+        else:
+            if os.fstat(file.fileno()).st_size <= get_entry_size():
+                with file:
+                    svg = file.read()
+                store_in_memory(key, svg)
+                return iter([svg])
+            return iter_disk_cache(file)
+    return iter_and_store(key, repertoire_svg_chunks(params))
@@ -0,0 +1,154 @@
+"""This module serves the drawing of the whole repertoire as square tiles of
+   nodes and edges, so that the graph page only loads the visible region.
+   The tidy layout of the repertoire is computed once per generation. Tiles
+   are indexed by zoom level: at level L, a unit of the layout is 2^L pixels
+   wide on screen, and a tile covers TILE_PIXELS pixels. Subtrees that would
+   be narrower than COLLAPSE_PIXELS on screen are collapsed into their root,
+   which then reports the number of nodes it hides.
+"""
+
+import math
+import threading
+from django.urls import reverse
+from .. import models
+from .draw import SvgNode, layout_tidy
+
+
+TILE_PIXELS = 512
+
+COLLAPSE_PIXELS = 48
+
+MAX_LEVEL = 0
+
+LAYOUT_PARAMS = {
+    "radius": 40.,
+    "hmargin": 10.,
+    "vmargin": 10.,
+}
+
+LAYOUTS = dict()
+
+LAYOUTS_LOCK = threading.Lock()
+
+
+def collapse_level(extent):
+    """Return the lowest level at which a subtree of a given horizontal
+       extent is drawn expanded
+    """
+    return math.ceil(math.log2(COLLAPSE_PIXELS / extent))
+
+
+class RepertoireLayout:
+
+    """Node coordinates of the whole repertoire, with a tile index per level"""
+
+    def __init__(self, generation):
+        self.generation = generation
+        self.nodes = list()
+        self.tiles = dict()
+        self.bounds = (0., 0., 0., 0.)
+        self.min_level = MAX_LEVEL
+        root = models.Node.objects.filter(parent=None).order_by("lft").first()
+        if root is None:
+            return
+        root, tree = root.tree()
+        index = {node: SvgNode(node, LAYOUT_PARAMS) for node in tree}
+        layout_tidy(index[root], tree, index, LAYOUT_PARAMS)
+        unit = 2 * LAYOUT_PARAMS["radius"] + LAYOUT_PARAMS["hmargin"]
+        order = list()
+        stack = [root]
+        while len(stack) > 0:
+            node = stack.pop()
+            order.append(node)
+            stack.extend(tree[node])
+        extents = dict()
+        sizes = dict()
+        for node in reversed(order):
+            x = index[node].position.x
+            low, high, size = x, x, 1
+            for child in tree[node]:
+                low = min(low, extents[child][0])
+                high = max(high, extents[child][1])
+                size += sizes[child]
+            extents[node] = (low, high)
+            sizes[node] = size
+        levels = dict()
+        for node in order:
+            low, high = extents[node]
+            levels[node] = collapse_level(high - low + unit)
+        xs = [svg_node.position.x for svg_node in index.values()]
+        ys = [svg_node.position.y for svg_node in index.values()]
+        margin = LAYOUT_PARAMS["radius"] + LAYOUT_PARAMS["hmargin"]
+        self.bounds = (min(xs) - margin, min(ys) - margin, max(xs) + margin, max(ys) + margin)
+        self.min_level = min(MAX_LEVEL, math.floor(math.log2(TILE_PIXELS / max(
+            self.bounds[2] - self.bounds[0],
+            self.bounds[3] - self.bounds[1],
+        ))))
+        for node in order:
+            parent = None if node.parent_id is None else node.parent
+            self.nodes.append({
+                "uid": node.uid,
+                "x": index[node].position.x,
+                "y": index[node].position.y,
+                "parent": None if parent is None else (index[parent].position.x, index[parent].position.y),
+                "label": node.label.replace(". ...", "..."),
+                "color": node.color(),
+                "hidden": sizes[node] - 1,
+                "expand_level": levels[node] if len(tree[node]) > 0 else self.min_level,
+                "show_level": self.min_level if parent is None else levels[parent],
+            })
+        for level in range(self.min_level, MAX_LEVEL + 1):
+            size = self.tile_size(level)
+            for i, node in enumerate(self.nodes):
+                if node["show_level"] <= level:
+                    key = (level, math.floor(node["x"] / size), math.floor(node["y"] / size))
+                    self.tiles.setdefault(key, list()).append(i)
+
+    @staticmethod
+    def tile_size(level):
+        """Width of a tile of a given level, in layout units"""
+        return TILE_PIXELS / 2 ** level
+
+    def describe(self):
+        """Serialize what the client needs to request tiles"""
+        return {
+            "generation": self.generation,
+            "bounds": self.bounds,
+            "radius": LAYOUT_PARAMS["radius"],
+            "tile_pixels": TILE_PIXELS,
+            "min_level": self.min_level,
+            "max_level": MAX_LEVEL,
+        }
+
+    def tile(self, level, column, row):
+        """Serialize the nodes of a tile, with the edges to their parents"""
+        level = min(max(level, self.min_level), MAX_LEVEL)
+        nodes = list()
+        for i in self.tiles.get((level, column, row), list()):
+            node = self.nodes[i]
+            nodes.append({
+                "uid": node["uid"],
+                "x": node["x"],
+                "y": node["y"],
+                "parent": node["parent"],
+                "label": node["label"],
+                "color": node["color"],
+                "href": reverse("openy:explore_node", kwargs={"uid": node["uid"]}),
+                "hidden": node["hidden"] if level < node["expand_level"] else 0,
+            })
+        return {
+            "generation": self.generation,
+            "level": level,
+            "nodes": nodes,
+        }
+
+
+def get_layout():
+    """Return the layout of the current repertoire generation"""
+    generation = models.RepertoireState.load().generation
+    with LAYOUTS_LOCK:
+        layout = LAYOUTS.get("repertoire")
+        if layout is None or layout.generation != generation:
+            layout = RepertoireLayout(generation)
+            LAYOUTS["repertoire"] = layout
+    return layout
@@ -1,83 +1,221 @@
 """This module gathers tools to build and use training exercises"""
 
+import bisect
 import chess
 from .. import models
 
 
 def get_node_coverage():
     """Return a dictionnary where keys are node UIDs and values inform whether
-       the node is included in an exercise, as white or as black.
+       the node is included in an exercise, as white or as black. Leaf left
+       values are sorted by color, so that a node is covered if one of them
+       falls within its nested set interval.
     """
-    coverage = {
-        node.uid: {chess.WHITE: False, chess.BLACK: False}
-        for node in models.Node.objects.all()
+    leaves = {chess.WHITE: list(), chess.BLACK: list()}
+    for color, lft in models.PositionTraining.objects.values_list(
+            "exercise__first_move", "node_leaf__lft"):
+        leaves[color].append(lft)
+    for lfts in leaves.values():
+        lfts.sort()
+
+    def covers(lfts, lft, rgt):
+        index = bisect.bisect_left(lfts, lft)
+        return index < len(lfts) and lfts[index] <= rgt
+
+    return {
+        uid: {
+            color: label != "" and covers(lfts, lft, rgt)
+            for color, lfts in leaves.items()
+        }
+        for uid, label, lft, rgt in models.Node.objects.values_list("uid", "label", "lft", "rgt")
     }
-    for position in models.PositionTraining.objects.all():
-        for ancestor in position.node_leaf.ancestors():
-            coverage[ancestor.uid][position.exercise.first_move] = True
-    return coverage
 
 
-def look_for_trainable_nodes():
-    """Select all leaves from the node tree that are worth training"""
-    selection = list()
-    for node in models.Node.objects.all():
-        if not (node.is_leaf() or node.is_pre_leaf()):
-            continue
-        if node.is_good_position(not node.turn(), -.1):
-            selection.append(node)
-    return selection
+PLACEMENT_TABLE = str.maketrans(dict(
+    [(str(empty), "." * empty) for empty in range(1, 9)] + [("/", None)]
+))
+
+
+def expand_placement(fen):
+    """Return the piece placement of a FEN string as a 64 characters string,
+       from a8 to h1, empty squares being dots
+    """
+    return fen.split(" ")[0].translate(PLACEMENT_TABLE)
+
+
+def placement_move_uci(parent_fen, fen):
+    """Return the UCI notation of the move between two positions, found by
+       comparing their piece placements, which is much faster than parsing
+       the positions and the SAN move
+    """
+    before = expand_placement(parent_fen)
+    after = expand_placement(fen)
+    own = str.isupper if parent_fen.split(" ")[1] == "w" else str.islower
+    origins = list()
+    targets = list()
+    for index, (old, new) in enumerate(zip(before, after)):
+        if old != new:
+            if own(old):
+                origins.append(index)
+            if own(new):
+                targets.append(index)
+    if len(origins) > 1:
+        origins = [index for index in origins if before[index] in "Kk"]
+        targets = [index for index in targets if after[index] in "Kk"]
+    origin, target = origins[0], targets[0]
+    promotion = ""
+    if before[origin] in "Pp" and after[target] not in "Pp":
+        promotion = after[target].lower()
+    return "%s%d%s%d%s" % (
+        "abcdefgh"[origin % 8],
+        8 - origin // 8,
+        "abcdefgh"[target % 8],
+        8 - target // 8,
+        promotion
+    )
 
 
-def build_exercise_to(node):
-    """Build a sequence of moves from the starting chess position to the
-       given node. Moves of the node's color asked after the returned 'root'
-       node are the bests according to the repertoire.
+def plan_exercises(selected=None):
+    """Return the (leaf, root, moves) triplets of the exercises to build for
+       the trainable nodes of the tree (or for those matching a predicate),
+       ordered by leaf UID. Trainable nodes are leaves and parents of leaves
+       reached with a good position for the side that just moved. The tree
+       is loaded at once and walked depth-first, carrying the current line
+       along with, for each side to move, the depth of the deepest move that
+       was not the best of the repertoire: moves of the trained side are
+       asked after that point, which is the exercise root.
     """
-    moves = list()
-    color = node.turn()
+    nodes = {
+        node.uid: node
+        for node in models.Node.objects.only("uid", "parent", "fen", "evaluation", "lft", "rgt")
+    }
+    children = dict()
     root = None
-    for ancestor in node.ancestors():
-        if ancestor.turn() == color and root is None:
-            if ancestor.is_best_move(not color):
-                moves.insert(0, "1 " + ancestor.move_uci())
-            else:
-                moves.insert(0, "0 " + ancestor.move_uci())
-                root = ancestor
+    for node in sorted(nodes.values(), key=lambda node: node.uid):
+        if node.parent_id is None:
+            root = node
         else:
-            moves.insert(0, "0 " + ancestor.move_uci())
-    return root, moves
+            children.setdefault(node.parent_id, list()).append(node)
+    best_moves = set()
+    for siblings in children.values():
+        pov = not siblings[0].turn()
+        best = sorted(
+            siblings,
+            key=lambda node: models.evaluation_to_float(node.evaluation),
+            reverse=pov
+        )[0]
+        best_moves.add(best.uid)
+    moves_uci = dict()
 
+    def move_uci(node):
+        if node.uid not in moves_uci:
+            moves_uci[node.uid] = placement_move_uci(nodes[node.parent_id].fen, node.fen)
+        return moves_uci[node.uid]
 
-def build_trainable_exercises():
-    """Selects and build appropriate exercises from to learn the repertoire.
+    plan = list()
+    path = list()
+    stack = [(child, 0, -1, -1) for child in reversed(children.get(root.uid, list()))]
+    while len(stack) > 0:
+        node, depth, last_white, last_black = stack.pop()
+        color = node.turn()
+        del path[depth:]
+        path.append((node, color))
+        if node.uid not in best_moves:
+            if color:
+                last_white = depth
+            else:
+                last_black = depth
+        node_children = children.get(node.uid, list())
+        trainable = all(child.uid not in children for child in node_children)
+        if trainable and node.is_good_position(not color, -.1)\
+                and (selected is None or selected(node)):
+            last = last_white if color else last_black
+            if last != depth:
+                plan.append((
+                    node,
+                    root if last < 0 else path[last][0],
+                    [
+                        "%d %s" % (turn == color and i > last, move_uci(ancestor))
+                        for i, (ancestor, turn) in enumerate(path)
+                    ]
+                ))
+        for child in reversed(node_children):
+            stack.append((child, depth + 1, last_white, last_black))
+    plan.sort(key=lambda item: item[0].uid)
+    return plan
+
+
+def create_exercises(plan):
+    """Save the exercises and their position trainings for a list of (leaf,
+       root, moves) triplets
     """
-    plan = {"exercises": list(), "trainings": list()}
-    root = models.Node.objects.filter(parent=None).get()
+    exercises = list()
+    trainings = list()
     eid_offset = 1
     if models.Exercise.objects.exists():
         eid_offset += models.Exercise.objects.latest("id").id
-    for i, node_leaf in enumerate(look_for_trainable_nodes()):
-        node_root, moves = build_exercise_to(node_leaf)
-        if node_root is None:
-            node_root = root
-        if node_root.uid == node_leaf.uid:
-            eid_offset -= 1
-            continue
-        eid = i + eid_offset
-        plan["exercises"].append(models.Exercise(
-            id=eid,
-            title="Openy Ex#%d" % (len(plan["exercises"]) + 1),
+    number_offset = models.PositionTraining.objects.count() + 1
+    for i, (node_leaf, node_root, moves) in enumerate(plan):
+        exercises.append(models.Exercise(
+            id=i + eid_offset,
+            title="Openy Ex#%d" % (i + number_offset),
             description="This exercise was generated by the Openy trainer.",
             starting_position="rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1",
             cover_position=node_leaf.fen,
             moves=",".join(moves),
             first_move=not node_leaf.turn(),
         ))
-        plan["trainings"].append(models.PositionTraining(
-            exercise_id=eid,
+        trainings.append(models.PositionTraining(
+            exercise_id=i + eid_offset,
             node_leaf=node_leaf,
             node_root=node_root,
         ))
-    models.Exercise.objects.bulk_create(plan["exercises"])
-    models.PositionTraining.objects.bulk_create(plan["trainings"])
+    models.Exercise.objects.bulk_create(exercises)
+    models.PositionTraining.objects.bulk_create(trainings)
+    models.RepertoireState.bump_exercises()
+
+
+def build_trainable_exercises():
+    """Selects and build appropriate exercises from to learn the repertoire.
+    """
+    create_exercises(plan_exercises())
+
+
+def rebuild_exercises(regions):
+    """Rebuild the exercises ending within the given subtrees, as a list of
+       nested set (left, right) intervals. Exercises that would be built
+       identically are kept, along with their training history.
+    """
+    regions = merge_intervals(regions)
+    if len(regions) == 0:
+        return
+    starts = [left for left, _ in regions]
+
+    def inside(node):
+        index = bisect.bisect_right(starts, node.lft) - 1
+        return index >= 0 and node.rgt <= regions[index][1]
+
+    current = dict()
+    for training in models.PositionTraining.objects.select_related("exercise", "node_leaf"):
+        if inside(training.node_leaf):
+            key = (training.node_leaf_id, training.node_root_id, training.exercise.moves)
+            current[key] = training.exercise_id
+    plan = list()
+    for node_leaf, node_root, moves in plan_exercises(inside):
+        key = (node_leaf.uid, node_root.uid, ",".join(moves))
+        if key in current:
+            del current[key]
+        else:
+            plan.append((node_leaf, node_root, moves))
+    models.Exercise.objects.filter(id__in=list(current.values())).delete()
+    create_exercises(plan)
+
+
+def merge_intervals(intervals):
+    """Sort nested set intervals, dropping those contained in another one"""
+    merged = list()
+    for left, right in sorted(intervals):
+        if len(merged) > 0 and right <= merged[-1][1]:
+            continue
+        merged.append((left, right))
+    return merged
@@ -1,19 +1,26 @@
 """Django views"""
 
+import os
 import re
 import json
-import random
-from django.http import HttpResponse
+import tempfile
+import operator
+import functools
+from django.http import HttpResponse, FileResponse, JsonResponse, StreamingHttpResponse
 from django.shortcuts import render
 from django.shortcuts import redirect
 from django.contrib.auth.decorators import login_required
-from django.template.defaultfilters import slugify
 from django.urls import reverse
-from django.db.models import Sum
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
 import chess
-from .utils.draw import repertoire_to_svg
-from .utils.train import build_trainable_exercises
-from .utils.misc import weighted_choice
+from .utils.svgcache import iter_cached_repertoire_svg
+from .utils.conditional import repertoire_condition
+from .utils.tiles import get_layout
+from .utils.jobs import start_upload, describe_job
+from .utils.book import get_book, get_book_path, find_child
+from .utils.sampler import choose_exercise, choose_exercises, update_training
 from . import models
 
 
@@ -36,37 +43,43 @@ def settings(request):
         profile.ease_coef = float(request.POST.get("ease_coef", 1))
         profile.elo_volatility = float(request.POST.get("elo_volatility", 10))
         profile.elo_spreading = float(request.POST.get("elo_spreading", 400))
+        if request.POST.get("scheduler") in dict(models.TrainingProfile.SCHEDULERS):
+            profile.scheduler = request.POST["scheduler"]
         profile.save()
     return render(request, "openy/settings.html", {
         "profile": profile,
+        "book": get_book_path() is not None,
+        "job": models.Job.objects.order_by("-id").first(),
     })
 
 
 @login_required
 def upload(request):
-    """Upload a new repertoire, which overrides any previous data"""
+    """Upload a new repertoire, which either overrides any previous data or
+       is merged into the current repertoire, keeping the training history.
+       The file is processed by a background job.
+    """
     if request.method == "POST" and request.FILES["file"]:
-        models.Exercise.objects.exclude(positiontraining=None).delete()
-        models.Node.objects.all().delete()
-        data = json.load(request.FILES["file"])
-        models.Node.objects.bulk_create([
-            models.Node(
-                uid=node["uid"],
-                fen=node["fen"],
-                evaluation=node["ev"],
-                comment=node["cmt"],
-                label=node["lbl"],
-                parent_id=node["p"],
-                line=node["line"],
-                slug=slugify(node["line"]),
-            )
-            for node in data
-        ])
-        build_trainable_exercises()
+        handle, path = tempfile.mkstemp(suffix=".json")
+        with os.fdopen(handle, "wb") as file:
+            for chunk in request.FILES["file"].chunks():
+                file.write(chunk)
+        if start_upload(path, request.POST.get("merge") == "1") is None:
+            os.remove(path)
     return redirect("openy:settings")
 
 
 @login_required
+def job(request):
+    """Report the progress of the latest background job"""
+    job_obj = models.Job.objects.order_by("-id").first()
+    if job_obj is None:
+        return JsonResponse({"job": None})
+    return JsonResponse({"job": describe_job(job_obj)})
+
+
+@login_required
+@repertoire_condition(no_cache=True)
 def explore(request, slug=""):
     """Explore the node database"""
     if not models.Node.objects.filter(slug=slug).exists():
@@ -74,6 +87,7 @@ def explore(request, slug=""):
     node = models.Node.objects.get(slug=slug)
     return render(request, "openy/explore.html", {
         "node": node,
+        "transpositions": node.transpositions().order_by("uid"),
     })
 
 
@@ -82,17 +96,56 @@ def explore_node(_, uid):
     """Same as explore view but with shortened URL"""
     if not models.Node.objects.filter(uid=uid).exists():
         return redirect("openy:home")
-    return redirect("openy:explore", slug=models.Node.objects.get(uid=uid).slug)
+    return redirect(models.Node.objects.get(uid=uid).href())
+
+
+@login_required
+def transpositions(request):
+    """List the repertoire nodes reaching the position given by a FEN string"""
+    key = models.fen_to_position_key(request.GET.get("fen", ""))
+    nodes = models.Node.objects.none()
+    if key is not None:
+        nodes = models.Node.objects.filter(position=key).order_by("uid")
+    return JsonResponse({
+        "nodes": [
+            {
+                "uid": node.uid,
+                "line": node.line,
+                "evaluation": node.evaluation,
+                "href": node.href(),
+            }
+            for node in nodes
+        ]
+    })
 
 
 @login_required
 def find_entry(request):
     """Check if given a node, a given FEN string corresponds to one of its children"""
     if request.method == "POST" and "fen" in request.POST and "uid" in request.POST:
-        children = models.Node.objects.filter(
-            parent__uid=int(request.POST["uid"]),
-            fen__startswith=request.POST["fen"]
-        )
+        book = get_book()
+        if book is not None and "parent" in request.POST:
+            try:
+                uid = find_child(
+                    book,
+                    chess.Board(request.POST["parent"]),
+                    request.POST["fen"],
+                    int(request.POST["uid"])
+                )
+            except ValueError:
+                uid = None
+            if uid is not None:
+                return HttpResponse(
+                    reverse("openy:explore_node", kwargs={"uid": uid}),
+                    content_type="text/plain"
+                )
+            return HttpResponse("null", content_type="text/plain")
+        children = models.Node.objects.filter(parent__uid=int(request.POST["uid"]))
+        key = models.fen_to_position_key(request.POST["fen"])
+        if key is None:
+            children = children.filter(fen__startswith=request.POST["fen"])
+        else:
+            children = children.filter(position=key)
         if children.exists():
             return HttpResponse(
                 reverse("openy:explore", kwargs={"slug": children.get().slug}),
@@ -102,6 +155,21 @@ def find_entry(request):
 
 
 @login_required
+def book(request):
+    """Download the repertoire as a Polyglot opening book"""
+    path = get_book_path()
+    if path is None or not os.path.isfile(path):
+        return redirect("openy:settings")
+    return FileResponse(
+        open(path, "rb"),
+        as_attachment=True,
+        filename="repertoire.bin",
+        content_type="application/octet-stream"
+    )
+
+
+@login_required
+@repertoire_condition(training=lambda request: request.GET.get("coverage", "0") != "0", no_cache=True)
 def draw(request):
     """Build a SVG from the database"""
     params = {
@@ -116,12 +184,13 @@ def draw(request):
         "bcolor": request.GET.get("bcolor", ""),
         "coverage": int(request.GET.get("coverage", 0)),
         "swidth": int(request.GET.get("swidth", 5)),
+        "layout": request.GET.get("layout", "breadth"),
     }
     if "pred" in request.GET:
         params["pred"] = int(request.GET["pred"])
     if "succ" in request.GET:
         params["succ"] = int(request.GET["succ"])
-    return HttpResponse(repertoire_to_svg(params), content_type="image/svg+xml")
+    return StreamingHttpResponse(iter_cached_repertoire_svg(params), content_type="image/svg+xml")
 
 
 @login_required
@@ -156,36 +225,23 @@ def train(request):
             )
             return redirect("openy:exercise", eid=exercise_obj.id)
         if "start_training" in request.POST:
-            trainings = models.PositionTraining.objects.all()
-            profile = models.TrainingProfile.load()
-            weights = [
-                training.get_training_weight(
-                    failure_coef=profile.failure_coef,
-                    inactivity_coef=profile.inactivity_coef,
-                    ease_coef=profile.ease_coef
-                )
-                for training in trainings
-            ]
-            choice = weighted_choice(trainings, weights)
-            return redirect("openy:exercise", eid=choice.exercise.id)
-    successes = 0
-    failures = 0
+            eid = choose_exercise()
+            if eid is None:
+                return redirect("openy:train")
+            return redirect("openy:exercise", eid=eid)
+    statistics = models.TrainingStatistics.current()
+    successes = statistics.successes
+    failures = statistics.failures
     success_coverage = ""
     success_ratio = ""
-    if models.PositionTraining.objects.exists():
-        successes = models.PositionTraining.objects.aggregate(Sum("successes"))[
-            "successes__sum"]
-        failures = models.PositionTraining.objects.aggregate(Sum("failures"))[
-            "failures__sum"]
-        success_coverage = "%.1f" % (
-            100
-            * models.PositionTraining.objects.filter(successes__gte=1).count()
-            / models.PositionTraining.objects.all().count()
-        )
-        if failures + successes == 0:
-            success_ratio = ""
-        else:
+    if statistics.trainings > 0:
+        success_coverage = "%.1f" % (100 * statistics.covered / statistics.trainings)
+        if failures + successes > 0:
             success_ratio = "%.1f" % (100 * successes / (failures + successes))
+    profile = models.TrainingProfile.load()
+    due = None
+    if profile.scheduler == models.TrainingProfile.SM2:
+        due = models.PositionTraining.objects.filter(due__lte=timezone.now()).count()
     return render(request, "openy/train.html", {
         "recent_trainings":
         models.PositionTraining.objects.exclude(
@@ -196,7 +252,8 @@ def train(request):
         "total_tries": successes + failures,
         "success_ratio": success_ratio.rstrip("0").rstrip("."),
         "success_coverage": success_coverage.rstrip("0").rstrip("."),
-        "elo": models.TrainingProfile.load().elo,
+        "elo": profile.elo,
+        "due": due,
     })
 
 
@@ -205,6 +262,73 @@ def board(request):
     return render(request, "openy/board.html", {})
 
 
+SESSION_SIZE = 10
+
+SESSION_MAX_SIZE = 50
+
+
+@login_required
+def session(request):
+    """Train a batch of exercises without leaving the page"""
+    return render(request, "openy/session.html", {
+        "size": SESSION_SIZE,
+    })
+
+
+@login_required
+def session_exercises(request):
+    """Pick a batch of exercises and serve everything needed to play them"""
+    try:
+        count = min(max(int(request.GET.get("count", SESSION_SIZE)), 1), SESSION_MAX_SIZE)
+    except ValueError:
+        count = SESSION_SIZE
+    ids = choose_exercises(count)
+    exercises = models.Exercise.objects\
+        .select_related("positiontraining__node_root")\
+        .in_bulk(ids)
+    payload = list()
+    for eid in ids:
+        exercise_obj = exercises.get(eid)
+        if exercise_obj is None:
+            continue
+        payload.append({
+            "id": exercise_obj.id,
+            "title": exercise_obj.title,
+            "description": exercise_obj.description,
+            "starting_position": exercise_obj.starting_position,
+            "moves": exercise_obj.moves,
+            "first_move": exercise_obj.first_move,
+            "explore": exercise_obj.positiontraining.node_root.href(),
+        })
+    return JsonResponse({"exercises": payload})
+
+
+@login_required
+def session_results(request):
+    """Record the outcomes of a batch of exercises, sent as a JSON list of
+       {"id": ..., "success": ...} objects in the results field
+    """
+    if request.method != "POST":
+        return JsonResponse({"error": "POST required"}, status=405)
+    try:
+        results = json.loads(request.POST.get("results", "[]"))
+        outcomes = [(int(result["id"]), bool(result["success"])) for result in results]
+    except (ValueError, TypeError, KeyError):
+        return JsonResponse({"error": "Malformed results"}, status=400)
+    trainings = models.PositionTraining.objects.in_bulk([eid for eid, _ in outcomes])
+    recorded = 0
+    with transaction.atomic():
+        profile = models.TrainingProfile.load()
+        for eid, outcome in outcomes:
+            if eid in trainings:
+                trainings[eid].add_try(outcome, profile)
+                recorded += 1
+        profile.save()
+    for training in trainings.values():
+        update_training(training)
+    return JsonResponse({"recorded": recorded, "elo": profile.elo})
+
+
 @login_required
 def exercise(request, eid):
     """View for one exercise session"""
@@ -221,7 +345,12 @@ def exercise_delete(_, eid):
     """Handle exercise deletion link"""
     if not models.Exercise.objects.filter(id=eid).exists():
         return redirect("openy:train")
-    models.Exercise.objects.get(id=eid).delete()
+    exercise_obj = models.Exercise.objects.get(id=eid)
+    trained = hasattr(exercise_obj, "positiontraining")
+    exercise_obj.delete()
+    if trained:
+        models.TrainingStatistics.rebuild()
+        models.RepertoireState.bump_exercises()
     return redirect("openy:train")
 
 
@@ -233,6 +362,7 @@ def exercise_success(_, eid):
     exercise_obj = models.Exercise.objects.get(id=eid)
     if hasattr(exercise_obj, "positiontraining"):
         exercise_obj.positiontraining.add_success()
+        update_training(exercise_obj.positiontraining)
     return redirect("openy:train")
 
 
@@ -244,6 +374,7 @@ def exercise_failure(request, eid):
     exercise_obj = models.Exercise.objects.get(id=eid)
     if hasattr(exercise_obj, "positiontraining"):
         exercise_obj.positiontraining.add_failure()
+        update_training(exercise_obj.positiontraining)
         if "progress" in request.GET:
             progress = int(request.GET["progress"]) - 1
             node = exercise_obj.positiontraining.node_leaf
@@ -254,15 +385,36 @@ def exercise_failure(request, eid):
 
 
 @login_required
+@repertoire_condition(max_age=3600)
 def graph(request):
     """Fancy draw of the whole repertoire"""
     return render(request, "openy/graph.html", {})
 
 
+@login_required
+@repertoire_condition(no_cache=True)
+def graph_layout(request):
+    """Describe the tiled drawing of the whole repertoire"""
+    return JsonResponse(get_layout().describe())
+
+
+@login_required
+@repertoire_condition(no_cache=True)
+def graph_tile(request):
+    """Serve the nodes of one tile of the whole repertoire drawing"""
+    try:
+        level = int(request.GET["level"])
+        column = int(request.GET["column"])
+        row = int(request.GET["row"])
+    except (KeyError, ValueError):
+        return JsonResponse({"error": "Invalid tile"}, status=400)
+    return JsonResponse(get_layout().tile(level, column, row))
+
+
 @login_required
 def summary(request):
     """Debug interface for exercise ELOs and weights"""
-    positions = models.PositionTraining.objects.all()
+    positions = models.PositionTraining.objects.select_related("exercise", "node_root")
     profile = models.TrainingProfile.load()
     order_by = request.GET.get("order_by", "computed_weight")
     desc = int(request.GET.get("desc", 1))
@@ -287,11 +439,12 @@ def summary(request):
 
 
 @login_required
+@repertoire_condition(no_cache=True)
 def notes(request):
     """Re-generate a note file with the repertoire"""
     indent = int(request.GET.get("indent", 4))
     text = ""
-    for node in models.Node.objects.all().order_by("uid"):
+    for node in models.Node.objects.all().order_by("lft"):
         if node.label == "":
             continue
         text += " " * (node.depth() - 3) * indent + \
@@ -309,15 +462,21 @@ def notes(request):
 def train_position(request):
     """Find an exercise that includes a given FEN position"""
     if request.method == "POST":
-        fen = request.POST.get("fen", "").split(" ")[0]
-        if models.Node.objects.filter(fen__startswith=fen).exists():
-            nodes = list(models.Node.objects
-                         .get(fen__startswith=fen)
-                         .tree(pred=None, succ=None)[1])
-            random.shuffle(nodes)
-            for node in nodes:
-                query = models.PositionTraining.objects.filter(
-                    node_leaf__uid=node.uid)
-                if query.exists():
-                    return redirect("openy:exercise", eid=query.get().exercise.id)
+        fen = request.POST.get("fen", "")
+        key = models.fen_to_position_key(fen)
+        if key is None:
+            nodes = models.Node.objects.filter(fen__startswith=fen.split(" ")[0])
+        else:
+            nodes = models.Node.objects.filter(position=key)
+        subtrees = [
+            Q(node_leaf__lft__gte=node.lft, node_leaf__rgt__lte=node.rgt)
+            for node in nodes
+        ]
+        if len(subtrees) > 0:
+            training = models.PositionTraining.objects\
+                .filter(functools.reduce(operator.or_, subtrees))\
+                .order_by("?")\
+                .first()
+            if training is not None:
+                return redirect("openy:exercise", eid=training.exercise_id)
     return redirect("openy:train")
@@ -0,0 +1,131 @@
+"""Benchmark for the notes parser.
+
+This script generates synthetic notes files of increasing sizes (random
+repertoire trees of legal moves) and measures the time needed to parse and
+prune them with scripts/parser.py. No engine is involved. Optionally, the
+peak memory allocated while parsing is reported (tracing allocations slows
+parsing down, so timings are then not representative).
+"""
+
+import os
+import time
+import codecs
+import random
+import argparse
+import tempfile
+import tracemalloc
+import importlib.util
+import chess
+
+
+def load_parser():
+    """Import scripts/parser.py, which would be shadowed by the standard
+       library parser module on older Python versions.
+    """
+    spec = importlib.util.spec_from_file_location(
+        "notes_parser",
+        os.path.join(os.path.dirname(os.path.abspath(__file__)), "parser.py")
+    )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def candidate_moves(board, rng, branching):
+    """Pick a few distinct legal moves, promotions excluded (the notes format
+       does not support them)
+    """
+    moves = [move for move in board.legal_moves if move.promotion is None]
+    return iter(rng.sample(moves, min(len(moves), rng.randint(1, branching))))
+
+
+def generate_notes(filename, size, branching, max_depth, seed=0):
+    """Write a notes file with the given number of moves, laid out as a
+       depth-first traversal of a random tree
+    """
+    rng = random.Random(seed)
+    board = chess.Board()
+    stack = [candidate_moves(board, rng, branching)]
+    written = 0
+    with codecs.open(filename, "w", "utf8") as file:
+        while written < size and len(stack) > 0:
+            move = next(stack[-1], None)
+            if move is None:
+                stack.pop()
+                if len(board.move_stack) > 0:
+                    board.pop()
+                continue
+            prefix = "%d. " % board.fullmove_number
+            if board.turn == chess.BLACK:
+                prefix += "... "
+            file.write("%s%s%s (%+.2f)\n" % (
+                "    " * (len(stack) - 1),
+                prefix,
+                board.san(move),
+                rng.uniform(-1, 1)
+            ))
+            written += 1
+            board.push(move)
+            if len(stack) < max_depth and not board.is_game_over():
+                stack.append(candidate_moves(board, rng, branching))
+            else:
+                board.pop()
+    return written
+
+
+def main():
+    """Main script function"""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "-s", "--sizes",
+        help="Number of moves of the generated files",
+        type=int,
+        nargs="+",
+        default=[10000, 100000, 1000000]
+    )
+    parser.add_argument(
+        "-b", "--branching",
+        help="Maximum number of moves per position",
+        type=int,
+        default=4
+    )
+    parser.add_argument(
+        "-d", "--depth",
+        help="Maximum depth (in plies) of the generated lines",
+        type=int,
+        default=30
+    )
+    parser.add_argument(
+        "-m", "--memory",
+        help="Report the peak memory allocated while parsing",
+        action="store_true"
+    )
+    args = parser.parse_args()
+    notes_parser = load_parser()
+    with tempfile.TemporaryDirectory() as directory:
+        for size in args.sizes:
+            filename = os.path.join(directory, "notes_%d.txt" % size)
+            written = generate_notes(filename, size, args.branching, args.depth)
+            if args.memory:
+                tracemalloc.start()
+            time_start = time.time()
+            repertoire = notes_parser.parse_notes(filename)
+            time_parse = time.time() - time_start
+            notes_parser.prune(repertoire[0])
+            time_total = time.time() - time_start
+            del repertoire
+            report = "%8d moves: parsed in %.2fs, pruned in %.2fs (%.0f moves/s)" % (
+                written,
+                time_parse,
+                time_total - time_parse,
+                written / time_total
+            )
+            if args.memory:
+                _, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+                report += ", peak memory %.0f MB" % (peak / 2 ** 20)
+            print(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -9,11 +9,19 @@ To get the engine, you may go to https://stockfishchess.org/ or
 https://komodochess.com/.
 """
 
+import os
 import re
 import json
+import time
+import heapq
+import asyncio
+import queue
+import sqlite3
 import codecs
 import logging
 import argparse
+import collections
+import concurrent.futures
 import tqdm
 import chess
 import chess.engine
@@ -24,12 +32,31 @@ logging.basicConfig(level=logging.CRITICAL)
 
 class Node:
 
-    """A node in the repertoire tree"""
+    """A node in the repertoire tree. To keep memory low on large notes, a
+       node does not hold a board, only the FEN of its position, from which
+       the board is rebuilt on demand.
+    """
+
+    __slots__ = (
+        "uid",
+        "parent",
+        "fen",
+        "evaluation",
+        "comment",
+        "label",
+        "illustrative",
+        "children",
+        "line",
+        "note_line",
+        "pruned",
+        "reference",
+        "alternatives",
+    )
 
     def __init__(self, uid, parent):
         self.uid = uid
         self.parent = parent
-        self.board = None
+        self.fen = None
         self.evaluation = None
         self.comment = ""
         self.label = ""
@@ -37,23 +64,36 @@ class Node:
         self.children = list()
         self.line = ""
         self.note_line = None
+        self.pruned = False
+        self.reference = None
+        self.alternatives = None
 
     def to_dict(self):
         """Serialization"""
-        return {
+        data = {
             "uid": self.uid,
-            "fen": self.board.fen(en_passant="fen"),
+            "fen": self.fen,
             "ev": self.evaluation,
             "cmt": self.comment,
             "p": self.parent,
             "lbl": self.label,
             "line": self.line,
         }
+        if self.reference is not None:
+            data["ref"] = self.reference
+        if self.alternatives is not None:
+            data["pv"] = self.alternatives
+        return data
+
+    def board(self):
+        """Rebuild the board of this node's position"""
+        return chess.Board(self.fen)
 
     def depth(self):
-        if self.board.turn == chess.WHITE:
-            return 2 * self.board.fullmove_number
-        return 2 * self.board.fullmove_number + 1
+        _, turn, _, _, _, fullmove_number = self.fen.split(" ")
+        if turn == "w":
+            return 2 * int(fullmove_number)
+        return 2 * int(fullmove_number) + 1
 
     def to_line(self, indent=4):
         if self.label == "":
@@ -65,8 +105,41 @@ class Node:
         return string
 
 
-def parse_notes(filename):
-    """Build a Node list from the note text file"""
+def extend_line(line, board, move):
+    """Append a move, played from the given position, to a line in standard
+       algebraic notation (as Board.variation_san would write it).
+    """
+    if board.turn == chess.WHITE:
+        return ("%s %d. %s" % (line, board.fullmove_number, board.san(move))).strip()
+    if line == "":
+        return "%d... %s" % (board.fullmove_number, board.san(move))
+    return "%s %s" % (line, board.san(move))
+
+
+def prune(root):
+    """List the nodes to keep (neither illustrative nor following a null
+       move), in breadth-first order.
+    """
+    pruned = list()
+    buffer = collections.deque([root])
+    while len(buffer) > 0:
+        node = buffer.popleft()
+        pruned.append(node)
+        for child in node.children:
+            if not child.pruned:
+                buffer.append(child)
+    return pruned
+
+
+def parse_notes(filename, merge_transpositions=False):
+    """Build a Node list from the note text file. The last node reached at
+       each move number and color is kept as the current line, along with
+       its board, so that each move is attached to its parent in constant
+       time. If transpositions are merged, a move reaching an already known
+       position (at the same move number) becomes a leaf referencing the
+       node first reaching it, and the moves following it in the notes are
+       attached to that node instead.
+    """
     with codecs.open(filename, "r", "utf8") as file:
         lines = file.readlines()
     valid_line_regex = re.compile(r"^ *(il. ?)?~?\d+")
@@ -77,8 +150,11 @@ def parse_notes(filename):
     root = Node(0, None)
     fullmove_number = 1
     turn = chess.WHITE
-    root.board = chess.Board()
+    root_board = chess.Board()
+    root.fen = root_board.fen(en_passant="fen")
     nodes = [root]
+    positions = dict()
+    open_lines = dict()
     for i, text_line in enumerate(lines):
         if text_line.strip() == "" or not valid_line_regex.match(text_line):
             continue
@@ -90,34 +166,49 @@ def parse_notes(filename):
             elif element == "...":
                 turn = chess.BLACK
             elif move_regex.match(element):
-                j = len(nodes) - 1
-                while j > 0:
-                    if nodes[j].board.fullmove_number == fullmove_number\
-                            and nodes[j].board.turn == turn:
-                        break
-                    j -= 1
-                parent = nodes[j]
+                parent, board = open_lines.get((fullmove_number, turn), (root, root_board))
+                if parent.reference is not None:
+                    while parent.reference is not None:
+                        parent = nodes[parent.reference]
+                    board = parent.board()
                 child = Node(len(nodes), parent.uid)
-                child.board = parent.board.copy()
                 move_san = move_regex.match(element).group(1)
                 if move_san == "*":
                     move = chess.Move.null()
                 else:
                     try:
-                        move = child.board.parse_san(move_san)
+                        move = board.parse_san(move_san)
                     except ValueError:
                         print("Invalid move '%s' at line %d" %
                               (move_san, i + 1))
                         return None
                 child.note_line = i + 1
-                child.board.push(move)
                 child.illustrative = "il. " in element
+                child.pruned = parent.pruned or child.illustrative or move == chess.Move.null()
+                if not child.pruned:
+                    child.line = extend_line(parent.line, board, move)
+                board = board.copy(stack=False)
+                board.push(move)
+                child.fen = board.fen(en_passant="fen")
                 child.label = "%d. " % fullmove_number
                 if turn == chess.BLACK:
                     child.label += "... "
                 child.label += move_san
-                parent.children.append(child)
+                if not merge_transpositions or child.pruned:
+                    parent.children.append(child)
+                else:
+                    key = (board.epd(), board.fullmove_number)
+                    if key not in positions:
+                        positions[key] = child
+                        parent.children.append(child)
+                    else:
+                        # Under the same parent, this is the same move written
+                        # twice: it is kept so that it is reported as a
+                        # duplicate, as without merging
+                        child.reference = positions[key].uid
+                        parent.children.append(child)
                 nodes.append(child)
+                open_lines[(board.fullmove_number, board.turn)] = (child, board)
                 turn = not turn
             elif element.startswith("(") and element.endswith(")"):
                 nodes[-1].evaluation = element[1:-1]
@@ -125,7 +216,154 @@ def parse_notes(filename):
     return nodes
 
 
-def evaluate(board, args):
+class EnginePool:
+
+    """A set of long-lived UCI engine processes shared by worker threads"""
+
+    def __init__(self, args):
+        self.engines = queue.Queue()
+        self.identity = None
+        options = {
+            "Contempt": args.contempt,
+            "Hash": args.hash,
+            "Threads": args.threads,
+        }
+        for _ in range(args.jobs):
+            engine = chess.engine.SimpleEngine.popen_uci(args.engine_exe)
+            engine.configure({
+                name: value
+                for name, value in options.items()
+                if name in engine.options
+            })
+            self.identity = engine.id.get("name", args.engine_exe)
+            self.engines.put(engine)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def analyse(self, board, limit, **kwargs):
+        """Run an analysis on the first available engine"""
+        engine = self.engines.get()
+        try:
+            return engine.analyse(board, limit, **kwargs)
+        finally:
+            self.engines.put(engine)
+
+    def close(self):
+        """Terminate all engine processes"""
+        while not self.engines.empty():
+            self.engines.get().quit()
+
+
+class EvaluationCache:
+
+    """Evaluations from previous runs, stored in a SQLite file. Entries are
+       keyed by the position (without move counters), the engine identity,
+       its contempt and the analysis depth.
+    """
+
+    def __init__(self, path, engine, contempt):
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS evaluation (
+                position TEXT NOT NULL,
+                engine TEXT NOT NULL,
+                contempt INTEGER NOT NULL,
+                depth INTEGER NOT NULL,
+                value TEXT NOT NULL,
+                PRIMARY KEY (position, engine, contempt, depth)
+            )
+        """)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS alternatives (
+                position TEXT NOT NULL,
+                engine TEXT NOT NULL,
+                contempt INTEGER NOT NULL,
+                depth INTEGER NOT NULL,
+                multipv INTEGER NOT NULL,
+                value TEXT NOT NULL,
+                PRIMARY KEY (position, engine, contempt, depth, multipv)
+            )
+        """)
+        self.engine = engine
+        self.contempt = contempt
+        self.hits = 0
+        self.misses = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def get(self, board, depth):
+        """Return the deepest known evaluation of at least the given depth,
+           or None if there is none.
+        """
+        row = self.connection.execute("""
+            SELECT value FROM evaluation
+            WHERE position = ? AND engine = ? AND contempt = ? AND depth >= ?
+            ORDER BY depth DESC LIMIT 1
+        """, (board.epd(), self.engine, self.contempt, depth)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return row[0]
+
+    def set(self, board, depth, value):
+        """Store an evaluation"""
+        self.connection.execute("""
+            INSERT OR REPLACE INTO evaluation (position, engine, contempt, depth, value)
+            VALUES (?, ?, ?, ?, ?)
+        """, (board.epd(), self.engine, self.contempt, depth, value))
+        self.connection.commit()
+
+    def get_deepest(self, board):
+        """Return the deepest known evaluation and its depth, or (0, None) if
+           there is none
+        """
+        row = self.connection.execute("""
+            SELECT depth, value FROM evaluation
+            WHERE position = ? AND engine = ? AND contempt = ?
+            ORDER BY depth DESC LIMIT 1
+        """, (board.epd(), self.engine, self.contempt)).fetchone()
+        if row is None:
+            self.misses += 1
+            return 0, None
+        self.hits += 1
+        return row[0], row[1]
+
+    def get_alternatives(self, board, depth, multipv):
+        """Return the deepest known MultiPV output of at least the given depth
+           and number of lines, or None if there is none.
+        """
+        row = self.connection.execute("""
+            SELECT value FROM alternatives
+            WHERE position = ? AND engine = ? AND contempt = ? AND depth >= ? AND multipv >= ?
+            ORDER BY depth DESC, multipv ASC LIMIT 1
+        """, (board.epd(), self.engine, self.contempt, depth, multipv)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])[:multipv]
+
+    def set_alternatives(self, board, depth, multipv, alternatives):
+        """Store a MultiPV output"""
+        self.connection.execute("""
+            INSERT OR REPLACE INTO alternatives (position, engine, contempt, depth, multipv, value)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, (board.epd(), self.engine, self.contempt, depth, multipv, json.dumps(alternatives)))
+        self.connection.commit()
+
+    def close(self):
+        """Close the underlying database"""
+        self.connection.close()
+
+
+def evaluate(board, pool, args):
     """Give the evaluation of a move"""
     if board.is_stalemate():
         return "0.00"
@@ -133,11 +371,12 @@ def evaluate(board, args):
         if board.turn == chess.WHITE:
             return "-M0"
         return "M0"
-    engine = chess.engine.SimpleEngine.popen_uci(args.engine_exe)
-    engine.configure({"Contempt": args.contempt})
-    output = engine.analyse(board, chess.engine.Limit(depth=args.depth))
-    score = output["score"]
-    engine.quit()
+    output = pool.analyse(board, chess.engine.Limit(depth=args.depth))
+    return format_score(output["score"])
+
+
+def format_score(score):
+    """Format an engine score from White's point of view"""
     if score.is_mate():
         value = score.white().mate()
         if value >= 0:
@@ -149,11 +388,227 @@ def evaluate(board, args):
     return "%.2f" % (.01 * value)
 
 
+def analyse_alternatives(board, pool, args):
+    """Run a MultiPV search on a position, and return its best moves along
+       with their evaluations
+    """
+    if board.is_game_over():
+        return list()
+    infos = pool.analyse(board, chess.engine.Limit(depth=args.depth), multipv=args.multipv)
+    alternatives = list()
+    for info in infos:
+        if len(info.get("pv", list())) == 0:
+            continue
+        alternatives.append({
+            "san": board.san(info["pv"][0]),
+            "ev": format_score(info["score"]),
+        })
+    return alternatives
+
+
+def evaluate_siblings(repertoire, pending, pool, cache, executor, args):
+    """Run one MultiPV search per branching position, and use it to score
+       the children that are among its principal variations. Scores are
+       then one ply shallower than individual evaluations, and are cached
+       as such. Return the nodes left to evaluate individually.
+    """
+    index = {node.uid: node for node in repertoire}
+    parents = dict()
+    for node in repertoire:
+        if node.reference is None and node.parent in index:
+            parents[node.parent] = index[node.parent]
+    parents = list(parents.values())
+    searches = list()
+    for node in parents:
+        node.alternatives = None
+        if not args.no_cache:
+            node.alternatives = cache.get_alternatives(node.board(), args.depth, args.multipv)
+        if node.alternatives is None:
+            searches.append(node)
+    results = ordered_map(
+        executor,
+        lambda node: analyse_alternatives(node.board(), pool, args),
+        searches,
+        4 * args.jobs
+    )
+    for node, alternatives in zip(searches, tqdm.tqdm(results, total=len(searches))):
+        node.alternatives = alternatives
+        cache.set_alternatives(node.board(), args.depth, args.multipv, alternatives)
+    scores = dict()
+    for node in parents:
+        board = node.board()
+        for alternative in node.alternatives:
+            child = board.copy(stack=False)
+            child.push_san(alternative["san"])
+            scores[child.epd()] = alternative["ev"]
+    remaining = list()
+    for node in pending:
+        board = node.board()
+        if board.epd() in scores and not board.is_game_over():
+            node.evaluation = scores[board.epd()]
+            cache.set(board, args.depth - 1, node.evaluation)
+        else:
+            remaining.append(node)
+    print("Scored %d move(s) with %d MultiPV search(es), %d left to evaluate." % (
+        len(pending) - len(remaining),
+        len(searches),
+        len(remaining)
+    ))
+    return remaining
+
+
+def ordered_map(executor, function, items, window):
+    """Same as executor.map, but only submitting a bounded number of tasks
+       ahead of the results being consumed.
+    """
+    pending = collections.deque()
+    for item in items:
+        pending.append(executor.submit(function, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while len(pending) > 0:
+        yield pending.popleft().result()
+
+
+def anytime_priority(node, depth, swing):
+    """Rank a node for its next search, lowest first. Positions never
+       evaluated always come first. Then shallow evaluations are deepened
+       first, favouring positions near the root and positions whose score
+       moved (in centipawns) between their last two searches.
+    """
+    return (depth > 0, depth + .25 * node.depth() - min(swing, 200) / 50, node.uid)
+
+
+async def evaluate_anytime(targets, args):
+    """Evaluate nodes by iterative deepening, two plies at a time, until
+       they all reach the target depth or the time or node budget runs out.
+       Every result is checkpointed in the evaluation cache, so that an
+       interrupted run resumes from the depths already reached.
+    """
+    engines = list()
+    options = {
+        "Contempt": args.contempt,
+        "Hash": args.hash,
+        "Threads": args.threads,
+    }
+    for _ in range(args.jobs):
+        _, engine = await chess.engine.popen_uci(args.engine_exe)
+        await engine.configure({
+            name: value
+            for name, value in options.items()
+            if name in engine.options
+        })
+        engines.append(engine)
+    identity = engines[0].id.get("name", args.engine_exe)
+    time_start = time.monotonic()
+    deadline = None if args.budget is None else time_start + args.budget
+    counters = {"searches": 0, "nodes": 0, "running": 0}
+    last_scores = dict()
+    heap = list()
+    condition = asyncio.Condition()
+    progress = tqdm.tqdm(unit="search")
+
+    def exhausted():
+        if deadline is not None and time.monotonic() >= deadline:
+            return True
+        return args.node_budget is not None and counters["nodes"] >= args.node_budget
+
+    async def work(engine, cache):
+        while True:
+            async with condition:
+                while len(heap) == 0 and counters["running"] > 0:
+                    await condition.wait()
+                if len(heap) == 0 or (heap[0][0][0] and exhausted()):
+                    condition.notify_all()
+                    return
+                _, node, depth = heapq.heappop(heap)
+                counters["running"] += 1
+            board = node.board()
+            limit = chess.engine.Limit(depth=min(args.depth, depth + 2))
+            if deadline is not None and node.evaluation is not None:
+                limit.time = max(0, deadline - time.monotonic())
+            info = await engine.analyse(board, limit)
+            reached = info.get("depth", limit.depth)
+            score = info["score"].white().score(mate_score=100000)
+            async with condition:
+                counters["running"] -= 1
+                counters["searches"] += 1
+                counters["nodes"] += info.get("nodes", 0)
+                progress.update()
+                if node.evaluation is None or reached > depth:
+                    node.evaluation = format_score(info["score"])
+                    cache.set(board, reached, node.evaluation)
+                    swing = abs(score - last_scores.get(node.uid, score))
+                    last_scores[node.uid] = score
+                    if reached < args.depth:
+                        heapq.heappush(heap, (anytime_priority(node, reached, swing), node, reached))
+                condition.notify_all()
+
+    try:
+        with EvaluationCache(args.cache_file, identity, args.contempt) as cache:
+            for node in targets:
+                board = node.board()
+                node.evaluation = None
+                if board.is_checkmate() or board.is_stalemate():
+                    node.evaluation = evaluate(board, None, args)
+                    continue
+                depth = 0
+                if not args.no_cache:
+                    depth, node.evaluation = cache.get_deepest(board)
+                if depth < args.depth:
+                    heapq.heappush(heap, (anytime_priority(node, depth, 0), node, depth))
+            await asyncio.gather(*[work(engine, cache) for engine in engines])
+            depths = [cache.get_deepest(node.board())[0] for node in targets]
+    finally:
+        progress.close()
+        for engine in engines:
+            await engine.quit()
+    print("Anytime evaluation: %d search(es), %d engine node(s) in %.0fs, depths %d to %d." % (
+        counters["searches"],
+        counters["nodes"],
+        time.monotonic() - time_start,
+        min(depths, default=0),
+        max(depths, default=0)
+    ))
+
+
 def evaluate_repertoire(repertoire, args):
-    """Evaluate a set of nodes"""
-    for node in tqdm.tqdm(repertoire):
-        if node.evaluation is None or args.override:
-            node.evaluation = evaluate(node.board, args)
+    """Evaluate a set of nodes, spreading them over a pool of engines.
+       Results are collected in input order, so that the output does not
+       depend on which engine finished first.
+    """
+    targets = [
+        node for node in repertoire
+        if node.reference is None and (node.evaluation is None or args.override)
+    ]
+    if len(targets) == 0 and args.multipv == 0:
+        return
+    if args.budget is not None or args.node_budget is not None:
+        asyncio.run(evaluate_anytime(targets, args))
+        return
+    with EnginePool(args) as pool:
+        with EvaluationCache(args.cache_file, pool.identity, args.contempt) as cache:
+            pending = list()
+            for node in targets:
+                node.evaluation = None
+                if not args.no_cache:
+                    node.evaluation = cache.get(node.board(), args.depth)
+                if node.evaluation is None:
+                    pending.append(node)
+            with concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs) as executor:
+                if args.multipv > 0:
+                    pending = evaluate_siblings(repertoire, pending, pool, cache, executor, args)
+                evaluations = ordered_map(
+                    executor,
+                    lambda node: evaluate(node.board(), pool, args),
+                    pending,
+                    4 * args.jobs
+                )
+                for node, evaluation in zip(pending, tqdm.tqdm(evaluations, total=len(pending))):
+                    node.evaluation = evaluation
+                    cache.set(node.board(), args.depth, evaluation)
+            if not args.no_cache:
+                print("Evaluation cache: %d hit(s), %d miss(es)." % (cache.hits, cache.misses))
 
 
 def main():
@@ -187,6 +642,58 @@ def main():
         type=int,
         default=0
     )
+    parser.add_argument(
+        "-j", "--jobs",
+        help="Number of engine processes running in parallel",
+        type=int,
+        default=1
+    )
+    parser.add_argument(
+        "-hs", "--hash",
+        help="Chess engine hash table size (in MB), per process",
+        type=int,
+        default=16
+    )
+    parser.add_argument(
+        "-th", "--threads",
+        help="Chess engine threads, per process",
+        type=int,
+        default=1
+    )
+    parser.add_argument(
+        "-ec", "--cache_file",
+        help="Path to the evaluation cache (defaults to a file next to the output)",
+        type=str,
+        default=None
+    )
+    parser.add_argument(
+        "-nc", "--no_cache",
+        help="Do not read evaluations from the cache",
+        action="store_true"
+    )
+    parser.add_argument(
+        "-pv", "--multipv",
+        help="Score sibling moves with a single MultiPV search of that many lines on their parent (0 to disable)",
+        type=int,
+        default=0
+    )
+    parser.add_argument(
+        "-b", "--budget",
+        help="Evaluate by iterative deepening up to the evaluation depth, within this many seconds",
+        type=float,
+        default=None
+    )
+    parser.add_argument(
+        "-bn", "--node_budget",
+        help="Same as --budget, with a total number of engine nodes",
+        type=int,
+        default=None
+    )
+    parser.add_argument(
+        "-m", "--merge",
+        help="Merge transpositions, evaluating each position once",
+        action="store_true"
+    )
     parser.add_argument(
         "-v", "--override",
         help="Override evaluations",
@@ -210,18 +717,12 @@ def main():
         default=4
     )
     args = parser.parse_args()
-    repertoire = parse_notes(args.note_txt)
+    if args.cache_file is None:
+        args.cache_file = os.path.join(os.path.dirname(args.output_json), "evaluations.sqlite3")
+    repertoire = parse_notes(args.note_txt, args.merge)
     if repertoire is not None:
         print("Loaded %d nodes from '%s'." % (len(repertoire), args.note_txt))
-        pruned = []
-        buffer = [repertoire[0]]
-        while len(buffer) > 0:
-            node = buffer.pop(0)
-            pruned.append(node)
-            for child in node.children:
-                if not child.illustrative and chess.Move.null() not in child.board.move_stack:
-                    child.line = chess.Board().variation_san(child.board.move_stack)
-                    buffer.append(child)
+        pruned = prune(repertoire[0])
         seen = dict()
         duplicates = False
         for node in pruned:
@@ -235,13 +736,19 @@ def main():
             print("Found duplicates, please remove them.")
             return True
         print("Kept %d nodes after pruning." % len(pruned))
-        print("Evaluating repertoire with engine '%s' at depth %d." %
-              (args.engine_exe, args.depth))
+        print("Evaluating repertoire with engine '%s' at depth %d, using %d process(es)." %
+              (args.engine_exe, args.depth, args.jobs))
         evaluate_repertoire(pruned, args)
+        references = [node for node in repertoire if node.reference is not None]
+        for node in references:
+            node.evaluation = repertoire[node.reference].evaluation
+        if len(references) > 0:
+            print("Merged %d transposition(s)." % len(references))
         if args.copy:
             print("Reproducing notes to '%s'" % args.copy_file)
             with codecs.open(args.copy_file, "w", "utf8") as file:
-                for node in sorted(pruned, key=lambda node: node.uid):
+                copied = set(pruned).union(node for node in references if not node.pruned)
+                for node in sorted(copied, key=lambda node: node.uid):
                     line = node.to_line(indent=args.copy_indent)
                     if line != "":
                         file.write(line + "\n")